@@ -0,0 +1,63 @@
+"""
+Latency of convolutional components in NCHW (contiguous) and NHWC (channels_last) memory formats on CPU.
+
+    python -m benchmarks.channels_last --channels 32 64 --sizes 64
+"""
+import argparse
+
+import torch
+
+from .components import COMPONENTS, DTYPES, forward, forward_backward
+from .utils import measure_latency, save_results
+
+CONV_COMPONENTS = ["conv", "separable_conv", "ResBlock", "ResBlock_stride2", "DenseBlock", "DenseBottleneckBlock"]
+FORMATS = {"contiguous": torch.contiguous_format, "channels_last": torch.channels_last}
+
+
+def benchmark_case(name, channels, batch, size, dtype, memory_format):
+    torch.manual_seed(0)
+
+    module, inputs = COMPONENTS[name](channels, batch, size, DTYPES[dtype])
+    module = module.to(DTYPES[dtype], memory_format=FORMATS[memory_format])
+    inputs = [x.to(memory_format=FORMATS[memory_format]) for x in inputs]
+    grad_inputs = [x.clone().requires_grad_(True) for x in inputs]
+
+    return {
+        "forward_ms": measure_latency(forward(module, inputs)) * 1e3,
+        "forward_backward_ms": measure_latency(forward_backward(module, grad_inputs)) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare contiguous and channels_last memory formats on CPU")
+    parser.add_argument("--components", nargs="+", default=CONV_COMPONENTS, choices=CONV_COMPONENTS)
+    parser.add_argument("--channels", nargs="+", type=int, default=[32, 64])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64])
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], choices=list(DTYPES))
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    results = dict()
+    for name in args.components:
+        for channels in args.channels:
+            for size in args.sizes:
+                for dtype in args.dtypes:
+                    case = f"{name}/c{channels}/s{size}/b{args.batch}/{dtype}"
+                    results[case] = {f: benchmark_case(name, channels, args.batch, size, dtype, f) for f in FORMATS}
+
+                    nchw, nhwc = results[case]["contiguous"], results[case]["channels_last"]
+                    print(f"{case:<50} fwd {nchw['forward_ms']:8.3f} -> {nhwc['forward_ms']:8.3f} ms "
+                          f"({nchw['forward_ms'] / nhwc['forward_ms']:4.2f}x)   "
+                          f"fwd+bwd {nchw['forward_backward_ms']:8.3f} -> {nhwc['forward_backward_ms']:8.3f} ms "
+                          f"({nchw['forward_backward_ms'] / nhwc['forward_backward_ms']:4.2f}x)")
+
+    if args.output:
+        save_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Micro-benchmarks of erlich.components on CPU.
+
+Each component is swept over input sizes, channel counts, dtypes and thread counts, measuring forward and
+forward+backward latency, throughput and peak memory.
+
+    python -m benchmarks.components --output results.json
+    python -m benchmarks.components --save-baseline benchmarks/baselines/components.json
+    python -m benchmarks.components --baseline benchmarks/baselines/components.json --threshold 0.1
+"""
+import argparse
+import sys
+
+import torch
+
+from erlich.components import conv, separable_conv, ResBlock, DenseBlock, DenseBottleneckBlock, ChannelAttention, \
+    AttentionPool
+from erlich.components.base import Swish
+
+from .utils import measure_latency, measure_peak_memory, save_results, load_results, compare
+
+DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+
+
+def image(batch, channels, size, dtype):
+    return torch.randn(batch, channels, size, size, dtype=dtype)
+
+
+# name -> function(channels, batch, size, dtype) returning (module, inputs)
+COMPONENTS = {
+    "conv": lambda c, b, s, dt: (conv(c, c, 3), [image(b, c, s, dt)]),
+    "separable_conv": lambda c, b, s, dt: (separable_conv(c, c, 3), [image(b, c, s, dt)]),
+    "ResBlock": lambda c, b, s, dt: (ResBlock(c, c), [image(b, c, s, dt)]),
+    "ResBlock_stride2": lambda c, b, s, dt: (ResBlock(c, 2 * c, stride=2), [image(b, c, s, dt)]),
+    "DenseBlock": lambda c, b, s, dt: (DenseBlock(c, c // 4, 4), [image(b, c, s, dt)]),
+    "DenseBottleneckBlock": lambda c, b, s, dt: (DenseBottleneckBlock(c, c // 4, 4), [image(b, c, s, dt)]),
+    "ChannelAttention": lambda c, b, s, dt: (ChannelAttention(c), [image(b, c, s, dt)]),
+    "AttentionPool": lambda c, b, s, dt: (AttentionPool(), [image(b, c, s, dt), image(b, 4, s, dt)]),
+    "Swish": lambda c, b, s, dt: (Swish(), [image(b, c, s, dt)]),
+}
+
+
+def forward_backward(module, inputs):
+    def run():
+        for x in inputs:
+            x.grad = None
+        module.zero_grad(set_to_none=True)
+
+        outputs = module(*inputs)
+        if isinstance(outputs, tuple):
+            outputs = outputs[0]
+        outputs.float().sum().backward()
+
+    return run
+
+
+def forward(module, inputs):
+    def run():
+        with torch.inference_mode():
+            module(*inputs)
+
+    return run
+
+
+def benchmark_case(name, channels, batch, size, dtype, threads):
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+
+    module, inputs = COMPONENTS[name](channels, batch, size, DTYPES[dtype])
+    module = module.to(DTYPES[dtype])
+    grad_inputs = [x.clone().requires_grad_(True) for x in inputs]
+
+    forward_latency = measure_latency(forward(module, inputs))
+    backward_latency = measure_latency(forward_backward(module, grad_inputs))
+
+    return {
+        "forward_ms": forward_latency * 1e3,
+        "forward_backward_ms": backward_latency * 1e3,
+        "forward_samples_per_s": batch / forward_latency,
+        "forward_backward_samples_per_s": batch / backward_latency,
+        "forward_peak_memory": measure_peak_memory(forward(module, inputs)),
+        "forward_backward_peak_memory": measure_peak_memory(forward_backward(module, grad_inputs)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark erlich components on CPU")
+    parser.add_argument("--components", nargs="+", default=list(COMPONENTS), choices=list(COMPONENTS))
+    parser.add_argument("--channels", nargs="+", type=int, default=[16, 64])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[32, 64])
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--dtypes", nargs="+", default=["float32", "bfloat16"], choices=list(DTYPES))
+    parser.add_argument("--threads", nargs="+", type=int, default=sorted({1, torch.get_num_threads()}))
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--save-baseline", help="write results as the new baseline")
+    parser.add_argument("--baseline", help="compare with this baseline, exit with status 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results = dict()
+    for name in args.components:
+        for channels in args.channels:
+            for size in args.sizes:
+                for dtype in args.dtypes:
+                    for threads in args.threads:
+                        case = f"{name}/c{channels}/s{size}/b{args.batch}/{dtype}/t{threads}"
+                        results[case] = benchmark_case(name, channels, args.batch, size, dtype, threads)
+                        r = results[case]
+                        print(f"{case:<60} fwd {r['forward_ms']:8.3f} ms   fwd+bwd {r['forward_backward_ms']:8.3f} ms"
+                              f"   peak {r['forward_backward_peak_memory'] / 2 ** 20:8.2f} MiB")
+
+    for path in [args.output, args.save_baseline]:
+        if path:
+            save_results(path, results)
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline),
+                              ["forward_ms", "forward_backward_ms", "forward_backward_peak_memory"], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions over {100 * args.threshold:.0f}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
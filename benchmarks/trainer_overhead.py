@@ -0,0 +1,146 @@
+"""
+Per-step overhead of BaseTrainer.train compared with an equivalent hand-written PyTorch loop, on CPU.
+
+Both loops run the same tiny model, data and `train_step` (which updates a configurable number of meters), so the
+difference in time is the cost of the framework: optimizer dict iteration, move_to_device, scheduler and logger calls,
+validation and checkpoint checks.
+
+    python -m benchmarks.trainer_overhead --batch-sizes 1 16 256 --meters 1 8 32
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from erlich import BaseTrainer, AverageEstimator, TensorLoader
+from erlich.logging import TrainLogger
+
+from .utils import save_results
+
+FEATURES = 32
+
+
+def make_model():
+    return nn.Sequential(nn.Linear(FEATURES, FEATURES), nn.ReLU(), nn.Linear(FEATURES, 1))
+
+
+def make_data(samples):
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(samples, FEATURES, generator=generator), torch.randn(samples, 1, generator=generator)
+
+
+class SyntheticTrainer(BaseTrainer):
+    def get_train_metrics(self):
+        return {f"meter_{i}": AverageEstimator(f"meter_{i}") for i in range(self.cfg.meters)}
+
+    def get_dataloader(self, batch_size):
+        return TensorLoader(*make_data(self.cfg.samples), batch_size=batch_size, shuffle=True, drop_last=True)
+
+    def train_step(self, batch, batch_idx, train_metrics):
+        x, y = batch
+        loss = torch.mean((self.model_parts["model"](x) - y) ** 2)
+
+        loss_value = loss.item()
+        for meter in train_metrics.values():
+            meter.update(loss_value)
+
+        return loss
+
+
+def run_erlich(batch_size, meters, samples, log_path):
+    cfg = OmegaConf.create({
+        "parts": {"model": {"arch": "mlp"}},
+        "optimizer": {"name": "adam", "lr": 1e-3},
+        "batch_size": batch_size,
+        "validation_batch_size": batch_size,
+        "epochs": 1,
+        "meters": meters,
+        "samples": samples,
+    })
+
+    torch.manual_seed(0)
+    logger = TrainLogger(log_path, cfg.epochs)
+    trainer = SyntheticTrainer(cfg, {"model": make_model()}, None, logger, torch.device("cpu"))
+    trainer.create_dataloaders()
+    trainer.instantiate_optimizers(cfg)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        trainer.train(logger_min_wait=5)
+        elapsed = time.perf_counter() - start
+
+    return elapsed, len(trainer.dataloader)
+
+
+def run_raw(batch_size, meters, samples):
+    torch.manual_seed(0)
+    model = make_model()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    dataloader = TensorLoader(*make_data(samples), batch_size=batch_size, shuffle=True, drop_last=True)
+    train_metrics = {f"meter_{i}": AverageEstimator(f"meter_{i}") for i in range(meters)}
+
+    start = time.perf_counter()
+    for x, y in dataloader:
+        optimizer.zero_grad()
+        loss = torch.mean((model(x) - y) ** 2)
+
+        loss_value = loss.item()
+        for meter in train_metrics.values():
+            meter.update(loss_value)
+
+        loss.backward()
+        optimizer.step()
+    elapsed = time.perf_counter() - start
+
+    return elapsed, len(dataloader)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure erlich's training loop overhead against a raw loop")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 16, 256])
+    parser.add_argument("--meters", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--steps", type=int, default=500, help="steps per epoch")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    log_path = os.path.join(tempfile.mkdtemp(), "overhead.log")
+
+    results = dict()
+    for batch_size in args.batch_sizes:
+        for meters in args.meters:
+            samples = batch_size * args.steps
+            erlich_times, raw_times = [], []
+            for _ in range(args.repeats):
+                t, steps = run_erlich(batch_size, meters, samples, log_path)
+                erlich_times.append(t / steps)
+                t, steps = run_raw(batch_size, meters, samples)
+                raw_times.append(t / steps)
+
+            erlich_step, raw_step = statistics.median(erlich_times), statistics.median(raw_times)
+            case = f"b{batch_size}/m{meters}"
+            results[case] = {
+                "erlich_step_us": erlich_step * 1e6,
+                "raw_step_us": raw_step * 1e6,
+                "overhead_us": (erlich_step - raw_step) * 1e6,
+                "overhead_fraction": (erlich_step - raw_step) / raw_step,
+            }
+            r = results[case]
+            print(f"{case:<12} erlich {r['erlich_step_us']:9.1f} us   raw {r['raw_step_us']:9.1f} us   "
+                  f"overhead {r['overhead_us']:8.1f} us ({100 * r['overhead_fraction']:5.1f}%)")
+
+    if args.output:
+        save_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
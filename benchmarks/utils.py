@@ -0,0 +1,78 @@
+import itertools
+import json
+import platform
+import statistics
+import time
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+def measure_latency(fn, warmup=3, min_time=0.2, min_runs=5, max_runs=1000):
+    """
+    Median latency of `fn` in seconds
+    """
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() - start < min_time):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    return statistics.median(times)
+
+
+def measure_peak_memory(fn):
+    """
+    Peak CPU memory (bytes) allocated by torch during `fn`, reconstructed from the profiler memory timeline
+    """
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    return max(itertools.accumulate((e.self_cpu_memory_usage for e in events), initial=0))
+
+
+def environment():
+    return {
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "max_threads": torch.get_num_threads(),
+    }
+
+
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(results, baseline, metrics, threshold=0.1):
+    """
+    Compare lower-is-better `metrics` of each case with the baseline, returns the list of regressions
+    (cases slower than the baseline by more than `threshold`)
+    """
+    regressions = []
+    for case in sorted(results):
+        if case not in baseline:
+            continue
+
+        for metric in metrics:
+            if metric not in results[case] or metric not in baseline[case]:
+                continue
+            ratio = results[case][metric] / baseline[case][metric]
+            status = "REGRESSION" if ratio > 1 + threshold else "ok"
+            print(f"{case:<60} {metric:<30} {ratio:6.2f}x  {status}")
+            if ratio > 1 + threshold:
+                regressions.append((case, metric, ratio))
+
+    return regressions
@@ -1,9 +1,8 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import TensorDataset, DataLoader
 import time
 
-from erlich import Erlich, BaseTrainer, AverageEstimator
+from erlich import Erlich, BaseTrainer, AverageEstimator, TensorLoader
 
 
 def create_model_part(architecture_name, cfg, global_cfg):
@@ -27,21 +26,20 @@ class MyTrainer(BaseTrainer):
     def get_dataloader(self, batch_size):
         img_size = self.cfg.img_size
         input_channels = self.cfg.input_channels
-        return DataLoader(TensorDataset(torch.Tensor(64, input_channels, img_size, img_size).normal_()),
-                          batch_size=batch_size, pin_memory=True,
-                          drop_last=True,
-                          shuffle=True,
-                          num_workers=4)
+        return TensorLoader(torch.Tensor(64, input_channels, img_size, img_size).normal_(),
+                            batch_size=batch_size,
+                            drop_last=True,
+                            shuffle=True,
+                            device=self.device)
 
     def get_validation_dataloader(self, validation_batch_size):
         img_size = self.cfg.img_size
         input_channels = self.cfg.input_channels
-        return DataLoader(TensorDataset(torch.Tensor(64, input_channels, img_size, img_size).normal_()),
-                          batch_size=validation_batch_size,
-                          pin_memory=True,
-                          drop_last=True,
-                          shuffle=True,
-                          num_workers=4)
+        return TensorLoader(torch.Tensor(64, input_channels, img_size, img_size).normal_(),
+                            batch_size=validation_batch_size,
+                            drop_last=True,
+                            shuffle=True,
+                            device=self.device)
 
     def train_step(self, batch, batch_idx, train_metrics):
         x, = batch
@@ -1,3 +1,5 @@
 from .manager import Erlich
 from .logging import AverageEstimator
-from .trainer import BaseTrainer
\ No newline at end of file
+from .trainer import BaseTrainer, precision_autocast
+from .data import TensorLoader
+from .ensemble import EnsemblePart
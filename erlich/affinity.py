@@ -0,0 +1,132 @@
+"""
+Partitioning of the CPU cores between ranks, data loader workers and background threads.
+
+Each rank spawned on the machine gets a contiguous block of cores, split between its main process (training
+computation, intra-op threads), its data loader workers and its background threads (asynchronous validation, metrics
+exporter). Without it every process uses all the cores for its intra-op threads and they oversubscribe the machine.
+When there are not enough cores the groups share them. OS affinity is only set where supported (Linux).
+"""
+import os
+
+import torch
+
+from .data import can_rebuild, rebuild_dataloader
+
+AFFINITY_DEFAULTS = {"cores": None, "background_cores": 1, "worker_cores": 1, "num_threads": None,
+                     "worker_threads": 1}
+
+
+def parse_cores(cores):
+    """
+    Cores from a list of indices or a string of ranges (e.g. "0-7,16-23")
+    """
+    if not isinstance(cores, str):
+        return sorted(int(x) for x in cores)
+
+    res = []
+    for item in cores.split(","):
+        if "-" in item:
+            first, last = item.split("-")
+            res += list(range(int(first), int(last) + 1))
+        elif item.strip():
+            res.append(int(item))
+    return sorted(res)
+
+
+def format_cores(cores):
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(f"{a}-{b}" if a != b else str(a) for a, b in ranges)
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def plan_cpu_layout(cores, rank, world_size, num_workers, background_cores=1, worker_cores=1):
+    """
+    Cores of the main process, of the background threads and of each data loader worker of `rank`
+    """
+    size, rest = divmod(len(cores), world_size)
+    if size == 0:
+        # more ranks than cores
+        rank_cores = [cores[rank % len(cores)]]
+    else:
+        start = rank * size + min(rank, rest)
+        rank_cores = cores[start:start + size + (1 if rank < rest else 0)]
+
+    # the main process keeps at least one core of its own
+    background = rank_cores[:background_cores] if len(rank_cores) > background_cores + 1 else []
+    free = rank_cores[len(background):]
+    n_worker_cores = max(0, min(num_workers * worker_cores, len(free) - 1))
+    main, worker_pool = free[:len(free) - n_worker_cores], free[len(free) - n_worker_cores:]
+
+    blocks = [worker_pool[i:i + worker_cores] for i in range(0, len(worker_pool), worker_cores)]
+    # workers share blocks (or the cores of the main process) when there are not enough of them
+    workers = [blocks[i % len(blocks)] if blocks else main for i in range(num_workers)]
+
+    return {"cores": rank_cores, "main": main, "background": background or main, "workers": workers}
+
+
+def format_layout(layout, num_threads):
+    workers = " | ".join(format_cores(x) for x in layout["workers"]) or "none"
+    return (f"cores {format_cores(layout['cores'])}, main {format_cores(layout['main'])} ({num_threads} threads), "
+            f"background {format_cores(layout['background'])}, data workers {workers}")
+
+
+def pin_current_thread(cores):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def pin_process(cores):
+    """
+    Set the affinity of all the existing threads of the process (e.g. the intra-op thread pool), new threads inherit
+    the affinity of the thread that creates them
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return
+
+    tasks = os.listdir("/proc/self/task") if os.path.exists("/proc/self/task") else ["0"]
+    for tid in tasks:
+        try:
+            os.sched_setaffinity(int(tid), cores)
+        except OSError:
+            # the thread has exited in the meantime
+            pass
+
+
+class WorkerAffinity:
+    """
+    `worker_init_fn` pinning each data loader worker to its cores, then calling the original `worker_init_fn`
+    """
+
+    def __init__(self, workers, num_threads, worker_init_fn=None):
+        self.workers = workers
+        self.num_threads = num_threads
+        self.worker_init_fn = worker_init_fn
+
+    def __call__(self, worker_id):
+        pin_current_thread(self.workers[worker_id % len(self.workers)])
+        torch.set_num_threads(self.num_threads)
+        if self.worker_init_fn is not None:
+            self.worker_init_fn(worker_id)
+
+
+def set_worker_affinity(dataloader, workers, num_threads):
+    """
+    Return `dataloader` with its workers pinned to `workers` (loaders that are not DataLoaders are returned as is)
+    """
+    if not can_rebuild(dataloader) or dataloader.num_workers == 0 or not workers:
+        return dataloader
+
+    worker_init_fn = dataloader.worker_init_fn
+    if isinstance(worker_init_fn, WorkerAffinity):
+        worker_init_fn = worker_init_fn.worker_init_fn
+    return rebuild_dataloader(dataloader, worker_init_fn=WorkerAffinity(workers, num_threads, worker_init_fn))
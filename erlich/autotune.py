@@ -0,0 +1,233 @@
+import io
+import os
+import time
+
+import torch
+
+from .data import can_rebuild, set_num_workers
+from .trainer import get_batch_size, get_rng_states, set_rng_states
+
+
+def is_out_of_memory(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e)
+
+
+def repeat(dataloader):
+    while True:
+        for batch in dataloader:
+            yield batch
+
+
+class AutoTuner:
+    """
+    Chooses the training batch size and the number of DataLoader workers by running a few probe steps through
+    `optimization_step` before training. On GPU the largest batch size that fits in memory is chosen, on CPU the one
+    with the best throughput. The number of workers is the smallest one for which waiting for data takes less than
+    `wait_threshold` of the step time.
+    The model, optimizers and RNG states are restored after probing.
+    """
+
+    def __init__(self, trainer, steps=5, warmup_steps=2, max_batch_size=4096, max_workers=-1, wait_threshold=0.05):
+        self.trainer = trainer
+        self.steps = steps
+        self.warmup_steps = warmup_steps
+        self.max_batch_size = max_batch_size
+        self.max_workers = max_workers if max_workers > 0 else os.cpu_count()
+        self.wait_threshold = wait_threshold
+
+        self.using_mixed_precision = trainer.precision != "fp32"
+        self.on_gpu = trainer.device.type == "cuda"
+        self.num_workers = trainer.cfg.get("num_workers", None)
+
+        self.state = None
+
+    def save_state(self):
+        buffer = io.BytesIO()
+        torch.save({
+            "parts": {k: self.trainer.model_parts[k].state_dict() for k in self.trainer.model_parts},
+            "optimizers": {k: self.trainer.optimizers[k].state_dict() for k in self.trainer.optimizers},
+            "scaler": self.trainer.scaler.state_dict(),
+        }, buffer)
+        self.state = (buffer, get_rng_states())
+
+    def restore_state(self):
+        buffer, rng_states = self.state
+        buffer.seek(0)
+        state = torch.load(buffer, map_location=self.trainer.device)
+
+        for k in state["parts"]:
+            self.trainer.model_parts[k].load_state_dict(state["parts"][k])
+        for k in state["optimizers"]:
+            self.trainer.optimizers[k].load_state_dict(state["optimizers"][k])
+        self.trainer.scaler.load_state_dict(state["scaler"])
+        set_rng_states(rng_states)
+
+        for meter in self.trainer.train_metrics.values():
+            if hasattr(meter, "reset"):
+                meter.reset()
+            if hasattr(meter, "reset_epoch"):
+                meter.reset_epoch()
+
+    def synchronize(self):
+        if self.on_gpu:
+            torch.cuda.synchronize(self.trainer.device)
+
+    def measure(self, dataloader):
+        """
+        Run probe steps on `dataloader`, returns samples per second and the fraction of time spent waiting for data
+        """
+        batches = repeat(dataloader)
+        samples = 0
+        wait_time = 0.0
+        start_time = time.perf_counter()
+
+        for i in range(self.warmup_steps + self.steps):
+            if i == self.warmup_steps:
+                self.synchronize()
+                samples = 0
+                wait_time = 0.0
+                start_time = time.perf_counter()
+
+            t = time.perf_counter()
+            batch = next(batches)
+            wait_time += time.perf_counter() - t
+
+            self.trainer.optimization_step(batch, i, self.using_mixed_precision)
+            samples += get_batch_size(batch)
+
+        self.synchronize()
+        elapsed = time.perf_counter() - start_time
+
+        return samples / elapsed, wait_time / elapsed
+
+    def probe(self, batch_size, num_workers=None):
+        """
+        Returns (samples per second, data wait fraction) or None if the batch doesn't fit in memory
+        """
+        dataloader = self.trainer.get_dataloader(batch_size)
+        if num_workers is not None:
+            dataloader = set_num_workers(dataloader, num_workers)
+
+        try:
+            return self.measure(dataloader)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            return None
+        finally:
+            for optim in self.trainer.optimizers.values():
+                optim.zero_grad(set_to_none=True)
+            del dataloader
+            if self.on_gpu:
+                torch.cuda.empty_cache()
+
+    def tune_batch_size(self, batch_size):
+        if self.on_gpu:
+            return self.largest_batch_size(batch_size)
+        return self.fastest_batch_size(batch_size)
+
+    def largest_batch_size(self, batch_size):
+        # shrink until the starting batch fits
+        while self.probe(batch_size, self.num_workers) is None:
+            if batch_size == 1:
+                raise Exception("Autotune: a batch of size 1 doesn't fit in memory")
+            batch_size //= 2
+
+        # grow exponentially, then binary search between the largest fitting size and the first failing one
+        low, high = batch_size, None
+        while high is None and low * 2 <= self.max_batch_size:
+            if self.probe(low * 2, self.num_workers) is None:
+                high = low * 2
+            else:
+                low *= 2
+
+        if high is not None:
+            while high - low > 1:
+                mid = (low + high) // 2
+                if self.probe(mid, self.num_workers) is None:
+                    high = mid
+                else:
+                    low = mid
+
+        print(f"Autotune: largest batch size that fits in memory is {low}")
+        return low
+
+    def fastest_batch_size(self, batch_size):
+        best_batch_size, best_speed = batch_size, 0.0
+        while batch_size <= self.max_batch_size:
+            result = self.probe(batch_size, self.num_workers)
+            if result is None:
+                break
+            speed, _ = result
+            print(f"Autotune: batch size {batch_size} -> {speed:.1f} samples/s")
+
+            # stop as soon as throughput stops improving
+            if speed <= best_speed:
+                break
+            best_batch_size, best_speed = batch_size, speed
+            batch_size *= 2
+
+        return best_batch_size
+
+    def tune_num_workers(self, batch_size):
+        # loaders that don't use worker processes have nothing to tune
+        if not can_rebuild(self.trainer.get_dataloader(batch_size)):
+            return None
+
+        candidates = [0] + [2 ** i for i in range(32) if 2 ** i <= self.max_workers]
+        best_workers, best_speed = None, 0.0
+        for num_workers in candidates:
+            result = self.probe(batch_size, num_workers)
+            if result is None:
+                break
+            speed, wait = result
+            print(f"Autotune: {num_workers} workers -> {speed:.1f} samples/s, waiting for data {100 * wait:.1f}%")
+
+            if speed > best_speed:
+                best_workers, best_speed = num_workers, speed
+            if wait < self.wait_threshold:
+                return num_workers
+
+        return best_workers
+
+    def tune(self):
+        self.save_state()
+        try:
+            batch_size = self.tune_batch_size(self.trainer.batch_size)
+            num_workers = self.tune_num_workers(batch_size)
+        finally:
+            self.restore_state()
+
+        return batch_size, num_workers
+
+
+def autotune(trainer, cfg):
+    """
+    Tune batch size and number of workers, returns the chosen values as a dict of configuration entries
+    """
+    print("=" * 20, "AUTOTUNE", "=" * 20)
+    tune_cfg = cfg.autotune if not isinstance(cfg.autotune, bool) else dict()
+    tuner = AutoTuner(trainer, **trainer.standardize_kwargs(tune_cfg, steps=5, warmup_steps=2, max_batch_size=4096,
+                                                             max_workers=-1, wait_threshold=0.05))
+    batch_size, num_workers = tuner.tune()
+
+    # keep the ratio between validation and training batch sizes
+    validation_batch_size = max(1, cfg.validation_batch_size * batch_size // cfg.batch_size)
+
+    tuned = {"batch_size": batch_size, "validation_batch_size": validation_batch_size}
+    if num_workers is not None:
+        tuned["num_workers"] = num_workers
+
+    print("Autotune:", tuned)
+    return tuned
+
+
+def apply_tuning(trainer, tuned):
+    for k in tuned:
+        trainer.cfg[k] = tuned[k]
+    # the saved configuration reproduces the run without tuning again
+    trainer.cfg["autotune"] = False
+
+    trainer.batch_size = trainer.cfg.batch_size
+    trainer.validation_batch_size = trainer.cfg.validation_batch_size
+    trainer.create_dataloaders()
@@ -0,0 +1,123 @@
+"""
+On-disk cache of the outputs of frozen model parts.
+
+The output of a frozen part for each sample of the training set is stored in a memory mapped `.npy` file the first
+time the sample is seen and read back afterwards. The cache is stored in a folder named after a hash of the part's
+weights and the number of samples, so changing the weights invalidates it. The inputs of the part must be a deterministic function of the
+sample index (i.e. no random augmentation before the frozen part).
+"""
+import glob
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import torch
+
+FEATURES_FILE = "features.npy"
+VALID_FILE = "valid.npy"
+
+
+def weights_hash(module):
+    h = hashlib.sha256()
+    for k, v in sorted(module.state_dict().items()):
+        h.update(k.encode())
+        if isinstance(v, torch.Tensor):
+            h.update(f"{v.dtype}{tuple(v.shape)}".encode())
+            h.update(v.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            h.update(repr(v).encode())
+    return h.hexdigest()[:16]
+
+
+def numpy_dtype(dtype):
+    try:
+        return torch.empty(0, dtype=dtype).numpy().dtype
+    except TypeError:
+        # e.g. bfloat16 outputs of autocast
+        return np.dtype(np.float32)
+
+
+def open_memmap(path, dtype, shape):
+    """
+    Open the array at `path`, creating it if needed. Creation is atomic so that several ranks can share the cache.
+    """
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        array.flush()
+        del array
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        os.remove(tmp_path)
+
+    array = np.lib.format.open_memmap(path, mode="r+")
+    if array.dtype != dtype or array.shape != shape:
+        raise Exception(f"Feature cache '{path}' has shape {array.shape} and dtype {array.dtype}, "
+                        f"expected {shape} and {dtype}")
+    return array
+
+
+class FeatureCache:
+    def __init__(self, path, part, num_samples, remove_stale=True):
+        # caches of previous weights are not valid anymore, and the number of samples tells apart datasets
+        self.path = os.path.join(path, f"{weights_hash(part)}-{num_samples}")
+        if remove_stale:
+            for stale in glob.glob(os.path.join(path, "*")):
+                if stale != self.path:
+                    shutil.rmtree(stale, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.num_samples = num_samples
+        self.dtype = None
+        self.store_dtype = None
+        self.features = None
+        self.valid = None
+
+        # the feature shape is only known from the first output, open the cache now if it already exists
+        if os.path.exists(os.path.join(self.path, VALID_FILE)):
+            features = np.lib.format.open_memmap(os.path.join(self.path, FEATURES_FILE), mode="r")
+            self.open(features.dtype, features.shape[1:])
+
+    def open(self, dtype, feature_shape):
+        self.features = open_memmap(os.path.join(self.path, FEATURES_FILE), dtype,
+                                    (self.num_samples, *feature_shape))
+        self.valid = open_memmap(os.path.join(self.path, VALID_FILE), np.dtype(np.bool_), (self.num_samples,))
+        self.store_dtype = torch.from_numpy(self.features[:0]).dtype
+
+    def get(self, indices, part, *inputs):
+        """
+        Features of the samples with dataset indices `indices`, the ones not cached yet are computed with
+        `part(*inputs)` and stored
+        """
+        indices = indices.cpu().numpy() if isinstance(indices, torch.Tensor) else np.asarray(indices)
+        device = inputs[0].device
+
+        missing = ~self.valid[indices] if self.valid is not None else np.ones(len(indices), dtype=np.bool_)
+        if missing.any():
+            mask = torch.from_numpy(missing).to(device)
+            output = part(*[x[mask] for x in inputs])
+            if not isinstance(output, torch.Tensor):
+                raise Exception("Feature cache only supports parts returning a single tensor")
+
+            if self.dtype is None:
+                self.dtype = output.dtype
+            if self.features is None:
+                self.open(numpy_dtype(output.dtype), tuple(output.shape[1:]))
+
+            self.features[indices[missing]] = output.detach().cpu().to(self.store_dtype).numpy()
+            # mark as valid only once the features are written
+            self.valid[indices[missing]] = True
+
+            if missing.all():
+                return output
+
+        features = torch.from_numpy(self.features[indices]).to(device)
+        return features.to(self.dtype) if self.dtype is not None else features
+
+    def flush(self):
+        if self.features is not None:
+            self.features.flush()
+            self.valid.flush()
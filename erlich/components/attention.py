@@ -1,5 +1,4 @@
 from erlich.components.base import get_activation
-from matplotlib.pyplot import sca
 import torch.nn as nn
 import torch.nn.quantized
 import torch.nn.functional as F
@@ -0,0 +1,154 @@
+"""
+Static cost model of the model parts.
+
+Parts are built on the meta device (no weights are allocated) and run on meta inputs with the shapes of their `jit`
+specification. A dispatch mode counts the FLOPs of the aten operations with the formulas of `torch.utils.flop_counter`
+(matrix multiplications, convolutions and attention, elementwise operations are not counted) and attributes them to
+the innermost module running them, saved tensors hooks measure the activations kept for the backward pass.
+Activations are counted in the dtype of the inputs, autocast is not simulated.
+"""
+from collections import defaultdict
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils.flop_counter import flop_registry
+
+
+def optimizer_states(optim_cfg):
+    """
+    Number of state tensors per parameter kept by an optimizer, None if unknown
+    """
+    name = optim_cfg.get("name", None)
+    if name in ["adam", "adamW"]:
+        return 3 if optim_cfg.get("amsgrad", False) else 2
+    if name == "sgd":
+        return 1 if optim_cfg.get("momentum", 0) else 0
+    return None
+
+
+class CostCounter(TorchDispatchMode):
+    def __init__(self, excluded_storages=()):
+        super().__init__()
+        # names of the modules being run, FLOPs and saved activation bytes are attributed to the last one
+        self.stack = []
+        self.backward = False
+        self.flops = defaultdict(int)
+        self.backward_flops = 0
+        self.activations = defaultdict(int)
+        # storages of parameters and buffers are not activations, views of a storage count once
+        self.seen_storages = set(excluded_storages)
+
+    def current(self):
+        return self.stack[-1] if self.stack else ""
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs if kwargs is not None else dict()
+        out = func(*args, **kwargs)
+
+        packet = func._overloadpacket
+        if packet in flop_registry:
+            flops = flop_registry[packet](*args, **kwargs, out_val=out)
+            if self.backward:
+                self.backward_flops += flops
+            else:
+                self.flops[self.current()] += flops
+
+        return out
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage._cdata not in self.seen_storages:
+            self.seen_storages.add(storage._cdata)
+            self.activations[self.current()] += storage.nbytes()
+        return tensor
+
+    def push(self, name):
+        self.stack.append(name)
+
+    def pop(self):
+        self.stack.pop()
+
+
+def inclusive(values, name):
+    """
+    Sum of the values of module `name` and of its submodules
+    """
+    if name == "":
+        return sum(values.values())
+    return sum(v for k, v in values.items() if k == name or k.startswith(name + "."))
+
+
+def analyze_part(module, inputs, trainable=True, depth=2):
+    """
+    Parameters, forward/backward FLOPs and saved activations of `module` (on the meta device) called on `inputs`.
+    Frozen parts (`trainable=False`) run without gradients, they neither save activations nor run backward.
+    Without inputs only the parameters are counted.
+    """
+    tensors = list(module.parameters()) + list(module.buffers())
+    counter = CostCounter({t.untyped_storage()._cdata for t in tensors})
+
+    handles = []
+    for name, submodule in module.named_modules():
+        handles.append(submodule.register_forward_pre_hook(lambda m, args, name=name: counter.push(name)))
+        handles.append(submodule.register_forward_hook(lambda m, args, output: counter.pop(), always_call=True))
+
+    try:
+        grad_context = torch.enable_grad() if trainable else torch.no_grad()
+        with counter, grad_context, torch.autograd.graph.saved_tensors_hooks(counter.pack, lambda t: t):
+            output = module(*inputs) if inputs else None
+
+            outputs = output if isinstance(output, (tuple, list)) else [output]
+            outputs = [x for x in outputs if isinstance(x, torch.Tensor) and x.requires_grad]
+            if trainable and outputs:
+                counter.backward = True
+                torch.autograd.backward([x.sum() for x in outputs])
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    modules = []
+    for name, submodule in module.named_modules():
+        if name.count(".") + 1 > depth and name != "":
+            continue
+        modules.append({
+            "name": name,
+            "type": type(submodule).__name__,
+            "params": sum(p.numel() for p in submodule.parameters()),
+            "flops": inclusive(counter.flops, name),
+            "activation_bytes": inclusive(counter.activations, name),
+        })
+
+    parameters = list(module.parameters())
+    return {
+        "modules": modules,
+        "params": sum(p.numel() for p in parameters),
+        "param_bytes": sum(p.numel() * p.element_size() for p in parameters),
+        "trainable_params": sum(p.numel() for p in parameters if p.requires_grad) if trainable else 0,
+        "trainable_bytes": sum(p.numel() * p.element_size() for p in parameters if p.requires_grad)
+        if trainable else 0,
+        "forward_flops": sum(counter.flops.values()),
+        "backward_flops": counter.backward_flops,
+        "activation_bytes": sum(counter.activations.values()),
+        "batch_size": inputs[0].size(0) if inputs and inputs[0].dim() > 0 else 1,
+    }
+
+
+def fmt_count(x):
+    for unit, scale in [("T", 1e12), ("G", 1e9), ("M", 1e6), ("K", 1e3)]:
+        if abs(x) >= scale:
+            return f"{x / scale:.2f}{unit}"
+    return f"{x:.0f}" if float(x).is_integer() else f"{x:.2f}"
+
+
+def fmt_bytes(x):
+    return f"{x / 2 ** 20:.2f} MiB"
+
+
+def print_part_costs(name, costs):
+    batch_size = costs["batch_size"]
+    print(f"Part '{name}' (batch size {batch_size})")
+    print(f"    {'Module':<40} {'Type':<20} {'Params':>10} {'FLOPs/sample':>14} {'Activations':>14}")
+    for m in costs["modules"]:
+        module_name = "  " * (m["name"].count(".") + 1 if m["name"] else 0) + (m["name"].rsplit(".", 1)[-1] or name)
+        print(f"    {module_name[:40]:<40} {m['type'][:20]:<20} {fmt_count(m['params']):>10} "
+              f"{fmt_count(m['flops'] / batch_size):>14} {fmt_bytes(m['activation_bytes']):>14}")
@@ -0,0 +1,220 @@
+import copy
+import itertools
+import warnings
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, IterableDataset, RandomSampler, Sampler
+
+
+class SkipBatchSampler(Sampler):
+    """
+    Wraps a batch sampler skipping its first `skip` batches.
+    Only the indices are generated for the skipped batches, no sample is loaded.
+    """
+
+    def __init__(self, batch_sampler, skip):
+        self.batch_sampler = batch_sampler
+        self.skip = skip
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.skip, None)
+
+    def __len__(self):
+        return max(len(self.batch_sampler) - self.skip, 0)
+
+
+def set_dataloader_epoch(dataloader, epoch, seed):
+    """
+    Make the data order of an epoch a deterministic function of (seed, epoch) so that it can be reproduced on resume
+    """
+    if hasattr(dataloader, "set_epoch"):
+        dataloader.set_epoch(epoch)
+        return
+
+    if not isinstance(dataloader, DataLoader):
+        return
+
+    sampler = dataloader.sampler
+    if hasattr(sampler, "set_epoch"):
+        # e.g. DistributedSampler
+        sampler.set_epoch(epoch)
+
+    # the same generator seeds both the shuffling and the workers
+    generator = torch.Generator()
+    generator.manual_seed(seed + epoch)
+    dataloader.generator = generator
+    if isinstance(sampler, RandomSampler):
+        sampler.generator = generator
+
+
+def skip_batches(dataloader, skip):
+    """
+    Return an iterable over the batches of `dataloader` that starts from batch `skip`.
+    When possible the batches are skipped in the sampler, otherwise they are loaded and discarded.
+    """
+    if skip <= 0:
+        return dataloader
+
+    if hasattr(dataloader, "skip_batches"):
+        return dataloader.skip_batches(skip)
+
+    if not can_rebuild(dataloader):
+        warnings.warn(f"Cannot skip batches in the sampler of {type(dataloader).__name__}, "
+                      f"loading and discarding {skip} batches")
+        return itertools.islice(dataloader, skip, None)
+
+    return rebuild_dataloader(dataloader, batch_sampler=SkipBatchSampler(dataloader.batch_sampler, skip))
+
+
+def can_rebuild(dataloader):
+    return isinstance(dataloader, DataLoader) and not isinstance(dataloader.dataset, IterableDataset) \
+        and dataloader.batch_sampler is not None
+
+
+def rebuild_dataloader(dataloader, batch_sampler=None, num_workers=None, worker_init_fn=None, sampler=None):
+    """
+    Create a DataLoader equivalent to `dataloader` with a different batch sampler (or sampler), number of workers
+    and/or `worker_init_fn`
+    """
+    num_workers = num_workers if num_workers is not None else dataloader.num_workers
+    worker_init_fn = worker_init_fn if worker_init_fn is not None else dataloader.worker_init_fn
+    multiprocess = num_workers > 0
+
+    if batch_sampler is not None or dataloader.batch_size is None:
+        batching = {"batch_sampler": batch_sampler if batch_sampler is not None else dataloader.batch_sampler}
+    else:
+        # keep the automatic batching so that batch_size and drop_last are still visible on the new loader
+        batching = {"sampler": sampler if sampler is not None else dataloader.sampler,
+                    "batch_size": dataloader.batch_size,
+                    "drop_last": dataloader.drop_last}
+
+    return DataLoader(dataloader.dataset,
+                      **batching,
+                      num_workers=num_workers,
+                      collate_fn=dataloader.collate_fn,
+                      pin_memory=dataloader.pin_memory,
+                      timeout=dataloader.timeout if multiprocess else 0,
+                      worker_init_fn=worker_init_fn,
+                      multiprocessing_context=dataloader.multiprocessing_context if multiprocess else None,
+                      generator=dataloader.generator,
+                      prefetch_factor=(dataloader.prefetch_factor or 2) if multiprocess else None,
+                      persistent_workers=dataloader.persistent_workers and multiprocess,
+                      pin_memory_device=dataloader.pin_memory_device)
+
+
+def set_num_workers(dataloader, num_workers):
+    """
+    Return `dataloader` using `num_workers` worker processes (loaders that are not DataLoaders are returned as is)
+    """
+    if not can_rebuild(dataloader) or dataloader.num_workers == num_workers:
+        return dataloader
+
+    return rebuild_dataloader(dataloader, num_workers=num_workers)
+
+
+class TensorLoader:
+    """
+    Batched loader for datasets of in-memory tensors (replaces DataLoader(TensorDataset(...))).
+    Batches are produced by gathering a slice of a shuffled permutation from each tensor, without per-sample indexing,
+    collation or worker processes. When `device` is given the whole dataset is moved there once.
+    In distributed runs each rank iterates a disjoint part of the permutation (padded to the same length).
+    """
+
+    def __init__(self, *tensors, batch_size=1, shuffle=False, drop_last=False, device=None, seed=0,
+                 num_replicas=None, rank=None):
+        assert len(tensors) > 0 and all(t.size(0) == tensors[0].size(0) for t in tensors)
+
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+        self.tensors = [t.to(device) for t in tensors] if device is not None else list(tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        n = self.tensors[0].size(0)
+        self.num_samples = (n + num_replicas - 1) // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def indices(self):
+        n = self.tensors[0].size(0)
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=generator)
+        else:
+            indices = torch.arange(n)
+
+        # pad to make the permutation evenly divisible among ranks
+        total_size = self.num_samples * self.num_replicas
+        if total_size > n:
+            indices = torch.cat((indices, indices[:total_size - n]))
+        indices = indices[self.rank:total_size:self.num_replicas]
+
+        if self.device is not None:
+            indices = indices.to(self.device)
+        return indices
+
+    def iterate(self, start_batch=0):
+        indices = self.indices()
+        for i in range(start_batch, len(self)):
+            batch_indices = indices[i * self.batch_size:(i + 1) * self.batch_size]
+            yield [t[batch_indices] for t in self.tensors]
+
+    def __iter__(self):
+        return self.iterate()
+
+    def skip_batches(self, skip):
+        return self.iterate(skip)
+
+
+def dataset_size(dataloader):
+    """
+    Number of samples of the whole dataset iterated by `dataloader` (on all the ranks), None if unknown
+    """
+    if isinstance(dataloader, TensorLoader):
+        return dataloader.tensors[0].size(0)
+    dataset = getattr(dataloader, "dataset", None)
+    return len(dataset) if hasattr(dataset, "__len__") else None
+
+
+def unshard_dataloader(dataloader):
+    """
+    Return `dataloader` iterating the whole dataset on every rank instead of a part of it, for TensorLoaders and
+    DataLoaders with a distributed sampler (e.g. DistributedSampler, ShardedSampler). Other loaders are returned as is.
+    """
+    if isinstance(dataloader, TensorLoader):
+        dataloader = copy.copy(dataloader)
+        dataloader.num_replicas, dataloader.rank = 1, 0
+        dataloader.num_samples = dataloader.tensors[0].size(0)
+        return dataloader
+
+    if not can_rebuild(dataloader) or getattr(dataloader.sampler, "num_replicas", 1) == 1:
+        return dataloader
+
+    sampler = copy.copy(dataloader.sampler)
+    sampler.num_replicas, sampler.rank = 1, 0
+    sampler.num_samples = len(sampler.dataset)
+    if hasattr(sampler, "total_size"):
+        sampler.total_size = sampler.num_samples
+
+    if dataloader.batch_size is not None:
+        return rebuild_dataloader(dataloader, sampler=sampler)
+    batch_sampler = copy.copy(dataloader.batch_sampler)
+    batch_sampler.sampler = sampler
+    return rebuild_dataloader(dataloader, batch_sampler=batch_sampler)
@@ -0,0 +1,143 @@
+"""
+Training of K replicas of a model in a single process.
+
+Each part of the model is replaced by an `EnsemblePart` holding K replicas, all of them are evaluated with a single
+batched call (`torch.func.functional_call` vectorised by `torch.func.vmap`) so that one forward/backward step trains
+the whole ensemble. Every replica has its own optimizers, schedulers and meters.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+from torch.func import functional_call, vmap
+
+
+def replica_name(name, replica):
+    return f"{name}@{replica}"
+
+
+class EnsemblePart(nn.Module):
+    """
+    K replicas of a model part. Outputs have a leading replica dimension, inputs are shared by all replicas unless
+    `per_replica=True` (e.g. outputs of another ensemble part).
+    Replicas keep separate parameters, stacked at each forward, so they can be optimized independently.
+    Buffers are read only: changes made during forward (e.g. BatchNorm running statistics) are not kept.
+    """
+
+    def __init__(self, replicas):
+        super().__init__()
+        self.replicas = nn.ModuleList(replicas)
+        # stateless copy evaluated by functional_call, not registered as a submodule
+        self.__dict__["base"] = copy.deepcopy(replicas[0]).to("meta")
+        self.base.train(self.training)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.base.train(mode)
+        return self
+
+    def stacked(self, named_tensors):
+        names = [k for k, _ in named_tensors(self.replicas[0])]
+        values = [[x for _, x in named_tensors(replica)] for replica in self.replicas]
+        return {k: torch.stack(x) for k, x in zip(names, zip(*values))}
+
+    def forward(self, *inputs, per_replica=False):
+        params = self.stacked(lambda m: m.named_parameters())
+        buffers = self.stacked(lambda m: m.named_buffers())
+
+        def run(p, b, *x):
+            return functional_call(self.base, (p, b), x)
+
+        in_dims = (0, 0) + (0 if per_replica else None,) * len(inputs)
+        return vmap(run, in_dims=in_dims, randomness="different")(params, buffers, *inputs)
+
+
+class EnsembleMeter:
+    """
+    A meter for each replica, `update` takes a value per replica (e.g. a tensor of shape [K])
+    """
+
+    def __init__(self, meter, n_replicas):
+        self.name = meter.name
+        self.meters = []
+        for replica in range(n_replicas):
+            m = copy.deepcopy(meter)
+            m.name = replica_name(meter.name, replica)
+            if hasattr(m, "len"):
+                m.len = max(m.len, len(m.name))
+            self.meters.append(m)
+
+    def update(self, x):
+        values = x.detach().reshape(-1).tolist() if isinstance(x, torch.Tensor) else list(x)
+        for meter, value in zip(self.meters, values):
+            meter.update(value)
+
+    def reset(self):
+        for meter in self.meters:
+            if hasattr(meter, "reset"):
+                meter.reset()
+
+    def reset_epoch(self):
+        for meter in self.meters:
+            if hasattr(meter, "reset_epoch"):
+                meter.reset_epoch()
+
+    def state_dict(self):
+        return {meter.name: meter.state_dict() for meter in self.meters if hasattr(meter, "state_dict")}
+
+    def load_state_dict(self, state_dict):
+        for meter in self.meters:
+            if meter.name in state_dict:
+                meter.load_state_dict(state_dict[meter.name])
+
+
+def split_replica_values(values):
+    """
+    Replace values that have one entry per replica with an entry for each replica (e.g. "loss" -> "loss@0", ...)
+    """
+    res = dict()
+    for k, v in values.items():
+        if isinstance(v, torch.Tensor) and v.numel() > 1:
+            for replica, x in enumerate(v.detach().reshape(-1).tolist()):
+                res[replica_name(k, replica)] = x
+        else:
+            res[k] = v
+    return res
+
+
+def replica_state_dict(state_dict, replica):
+    """
+    State dict of a replica from the state dict of an EnsemblePart
+    """
+    prefix = f"replicas.{replica}."
+    return {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+
+
+def is_ensemble_state_dict(state_dict):
+    return any(k.startswith("replicas.") for k in state_dict)
+
+
+def replica_checkpoint(checkpoint, replica):
+    """
+    Checkpoint of a single replica, in the same format of a model trained without ensemble
+    """
+    suffix = f"@{replica}"
+
+    def select(d):
+        return {k[:-len(suffix)]: v for k, v in d.items() if k.endswith(suffix)}
+
+    # frozen parts are shared by all replicas
+    parts = {k: replica_state_dict(v, replica) if is_ensemble_state_dict(v) else v
+             for k, v in checkpoint["parts"].items()}
+
+    trainer_state = checkpoint.get("trainer")
+    if trainer_state is not None:
+        trainer_state = dict(trainer_state)
+        trainer_state["schedulers"] = select(trainer_state.get("schedulers", dict()))
+        trainer_state["metrics"] = {k: v[replica_name(k, replica)] for k, v in trainer_state.get("metrics", dict()).items()
+                                    if replica_name(k, replica) in v}
+
+    return {"parts": parts, "optimizers": select(checkpoint["optimizers"]), "trainer": trainer_state}
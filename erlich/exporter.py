@@ -0,0 +1,120 @@
+"""
+Prometheus endpoint exposing the state of a running training.
+
+The training thread only publishes a dict of values (a single reference assignment), the HTTP server thread formats
+them and queries process and device memory when scraped, so scraping never blocks training.
+"""
+import os
+import resource
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from .affinity import pin_current_thread
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # peak instead of current RSS where /proc is not available (kilobytes on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsExporter:
+    def __init__(self, port, host="127.0.0.1", device=None, cores=None):
+        self.port = port
+        self.host = host
+        self.device = torch.device(device) if device is not None else None
+        # CPU cores of the server threads
+        self.cores = cores
+
+        self.values = dict()
+        self.meters = dict()
+        self.server = None
+        self.thread = None
+
+    def publish(self, values, meters):
+        """
+        Called by the training thread, `values` and `meters` must not be modified afterwards
+        """
+        self.values, self.meters = values, meters
+
+    def render(self):
+        values, meters = self.values, self.meters
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE erlich_{name} {kind}")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                lines.append(f"erlich_{name}{{{label_str}}} {float(value)}" if label_str
+                             else f"erlich_{name} {float(value)}")
+
+        for key, name, kind in [("epoch", "epoch", "gauge"), ("step", "steps_total", "counter"),
+                                ("samples", "samples_total", "counter"),
+                                ("samples_per_second", "samples_per_second", "gauge"),
+                                ("data_wait_fraction", "data_wait_fraction", "gauge"),
+                                ("step_time_min", "step_time_min_seconds", "gauge"),
+                                ("step_time_max", "step_time_max_seconds", "gauge"),
+                                ("slowest_rank", "slowest_rank", "gauge")]:
+            if key in values:
+                metric(name, kind, [({}, values[key])])
+
+        metric("meter", "gauge", [({"name": k}, v[0]) for k, v in meters.items() if v[0] is not None])
+        metric("meter_epoch", "gauge", [({"name": k}, v[1]) for k, v in meters.items() if v[1] is not None])
+
+        metric("process_resident_memory_bytes", "gauge", [({}, resident_memory())])
+        if self.device is not None and self.device.type == "cuda":
+            labels = {"device": str(self.device)}
+            metric("device_memory_allocated_bytes", "gauge", [(labels, torch.cuda.memory_allocated(self.device))])
+            metric("device_memory_reserved_bytes", "gauge", [(labels, torch.cuda.memory_reserved(self.device))])
+            metric("device_max_memory_allocated_bytes", "gauge",
+                   [(labels, torch.cuda.max_memory_allocated(self.device))])
+
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        def serve():
+            # request threads inherit the affinity of the server thread
+            if self.cores is not None:
+                pin_current_thread(self.cores)
+            self.server.serve_forever()
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=serve, name="erlich-metrics", daemon=True)
+        self.thread.start()
+        print(f"Serving training metrics at http://{self.host}:{self.server.server_address[1]}/metrics")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+            self.thread = None
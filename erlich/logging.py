@@ -2,6 +2,9 @@ import time
 import json
 
 import torch
+import torch.distributed as dist
+
+from .exporter import MetricsExporter
 
 
 class Counter:
@@ -66,6 +69,15 @@ class AverageEstimator:
     def get_current_value(self):
         return self.val / max(self.count, 1)
 
+    def state_dict(self):
+        return {"val": self.val, "count": self.count, "epoch_val": self.epoch_val, "epoch_count": self.epoch_count}
+
+    def load_state_dict(self, state_dict):
+        self.val = state_dict["val"]
+        self.count = state_dict["count"]
+        self.epoch_val = state_dict["epoch_val"]
+        self.epoch_count = state_dict["epoch_count"]
+
     def to_str(self, curr_epoch, curr_batch):
         if self.count > 0:
             mean = self.fmt.format(self.get_current_value())
@@ -78,6 +90,95 @@ class AverageEstimator:
         return res + " " * (self.len - len(res))
 
 
+class MetricsReducer:
+    """
+    Aggregates the meters of all ranks with a single all-reduce, every rank must call `step` after each batch and
+    `end_epoch` at the end of each epoch.
+    Rank 0 chooses when the next reduction happens (after `min_wait` seconds) and sends the number of steps to wait
+    in the same all-reduce, so all ranks stay in sync without communicating at every step. Each rank also sends its
+    mean step time to find stragglers: the time spent waiting for data and in the forward pass, which excludes the
+    time spent waiting for the other ranks in gradient synchronization.
+    """
+
+    def __init__(self, meters, device, rank, world_size, min_wait=5):
+        # meters that can be summed across ranks
+        self.meters = [m for m in meters if all(hasattr(m, x) for x in ["val", "count", "epoch_val", "epoch_count"])]
+        self.device = device
+        self.rank = rank
+        self.world_size = world_size
+        self.min_wait = min_wait
+
+        self.steps = 0
+        self.next_reduce = 1
+        self.window_steps = 0
+        self.window_time = 0.0
+        self.window_start = time.perf_counter()
+        self.step_times = []
+
+    def step(self, step_time, last_batch=False):
+        """
+        Returns True if meters have been reduced (i.e. they hold the global values of the last window)
+        """
+        self.steps += 1
+        self.window_steps += 1
+        self.window_time += step_time
+
+        # the last batch is reduced and logged by `end_epoch`
+        if self.steps < self.next_reduce or last_batch:
+            return False
+
+        self.reduce()
+        return True
+
+    def reduce_due(self, last_batch=False):
+        """
+        True if meters will be reduced after the next step, known in advance by all ranks
+        """
+        return last_batch or self.steps + 1 >= self.next_reduce
+
+    def end_epoch(self):
+        self.reduce()
+
+    def reduce(self):
+        step_time = self.window_time / max(self.window_steps, 1)
+        # the interval until the next reduction is based on the actual time per step
+        wall_step_time = (time.perf_counter() - self.window_start) / max(self.window_steps, 1)
+
+        # meter sums, per-rank step times and the number of steps until the next reduction, in one tensor
+        n = 2 * len(self.meters)
+        values = [0.0] * (n + self.world_size + 1)
+        for i, m in enumerate(self.meters):
+            values[2 * i], values[2 * i + 1] = m.val, m.count
+        values[n + self.rank] = step_time
+        if self.rank == 0:
+            values[-1] = max(1, round(self.min_wait / max(wall_step_time, 1e-9)))
+
+        buffer = torch.tensor(values, dtype=torch.float64, device=self.device)
+        dist.all_reduce(buffer)
+        values = buffer.tolist()
+
+        for i, m in enumerate(self.meters):
+            val, count = values[2 * i], values[2 * i + 1]
+            # epoch totals receive the contribution of the other ranks in this window
+            m.epoch_val += val - m.val
+            m.epoch_count += count - m.count
+            m.val, m.count = val, count
+
+        self.step_times = values[n:n + self.world_size]
+        self.next_reduce = self.steps + int(values[-1])
+        self.window_steps = 0
+        self.window_time = 0.0
+        self.window_start = time.perf_counter()
+
+    def stats(self):
+        slowest = max(range(self.world_size), key=lambda r: self.step_times[r])
+        return {
+            "step_time_min": min(self.step_times),
+            "step_time_max": self.step_times[slowest],
+            "slowest_rank": slowest,
+        }
+
+
 def fmt_time(s):
     hours = s // 3600
     s = s - (hours * 3600)
@@ -93,9 +194,12 @@ class TimeEstimator:
         self.epochs = epochs
 
         self.start_time = 0
+        self.start_batches = 0
 
-    def start(self):
+    def start(self, start_batches=0):
         self.start_time = time.time()
+        # batches processed before start (e.g. when resuming), excluded from speed estimation
+        self.start_batches = start_batches
 
     def to_str(self, curr_epoch, curr_batch):
         elapsed_time = time.time() - self.start_time
@@ -103,7 +207,7 @@ class TimeEstimator:
 
         processed_batches = (curr_epoch - 1) * self.batches + curr_batch
 
-        mean_time_per_batch = elapsed_time / processed_batches
+        mean_time_per_batch = elapsed_time / (processed_batches - self.start_batches)
         remaining_time = mean_time_per_batch * (total_batches - processed_batches)
         remaining_time_epoch = mean_time_per_batch * (self.batches - curr_batch)
 
@@ -113,7 +217,7 @@ class TimeEstimator:
 
 
 class TrainLogger:
-    def __init__(self, log_path, n_epochs):
+    def __init__(self, log_path, n_epochs, append=False):
         self.log_path = log_path
         self.n_epochs = n_epochs
         self.n_batches = -1
@@ -128,24 +232,78 @@ class TrainLogger:
         self.last_log_time = 0
         self.train_start_time = -1
 
-        self.log_file = open(self.log_path, "w")
+        self.log_file = open(self.log_path, "a" if append else "w")
+
+        # optional Prometheus endpoint, values are published at most every `publish_every` seconds
+        self.exporter = None
+        self.publish_every = 1.0
+        self.last_publish_time = 0
+        self.samples = 0
+        self.window_samples = 0
+        self.window_data_time = 0.0
+        self.meter_values = dict()
+
+        # additional values logged with the meters (e.g. step times of all ranks)
+        self.extra = dict()
+        # values measured at the logged step only (e.g. gradient norms), written once
+        self.statistics = dict()
+
+    def start_exporter(self, port, host="127.0.0.1", device=None, publish_every=1.0, cores=None):
+        self.exporter = MetricsExporter(port, host, device, cores)
+        self.publish_every = publish_every
+        self.exporter.start()
+
+    def stop_exporter(self):
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
 
     def add_meter(self, meter):
         self.meters.append(meter)
 
-    def start(self, dataloader):
+    def start(self, dataloader, start_epoch=0, start_batch=0):
         self.n_batches = len(dataloader)
         self.batch_counter = Counter("Batch", self.n_batches)
 
-        self.time = TimeEstimator(self.n_batches, self.n_epochs)
-        self.time.start()
+        # counters are 1-based while epoch and batch are 0-based
+        self.epoch_counter.c = start_epoch + 1
+        self.batch_counter.c = start_batch
 
-    def batch(self):
+        self.time = TimeEstimator(self.n_batches, self.n_epochs)
+        self.time.start(start_epoch * self.n_batches + start_batch)
+
+        # resuming in the middle of an epoch, headers would be printed only at the next one
+        if start_batch > 0:
+            self.log_headers()
+        # a resumed run keeps accumulating the restored meters for `min_wait` seconds, as the interrupted run would
+        # have, instead of logging (and resetting them) at its first batch
+        if start_epoch > 0 or start_batch > 0:
+            self.last_log_time = time.time()
+
+        self.last_publish_time = time.time()
+
+    def log_due(self, last_batch=False):
+        """
+        True if the next batch will be logged when its logging is decided based on `min_wait`
+        """
+        return last_batch or time.time() - self.last_log_time >= self.min_wait
+
+    def batch(self, samples=0, data_time=0.0, log=None):
+        """
+        `log` forces (or prevents) logging at this batch instead of deciding based on `min_wait`
+        """
         self.batch_counter.increment()
         t = time.time()
 
+        if self.exporter is not None:
+            self.samples += samples
+            self.window_samples += samples
+            self.window_data_time += data_time
+            if t - self.last_publish_time >= self.publish_every:
+                self.publish(t)
+
         # don't log last batch because it will be logged by epoch()
-        if t - self.last_log_time >= self.min_wait:
+        if (log if log is not None else t - self.last_log_time >= self.min_wait):
             if self.batch_counter.c == 1:
                 self.log_headers()
             if self.batch_counter.c < self.n_batches:
@@ -158,6 +316,8 @@ class TrainLogger:
 
     def epoch(self):
         self.log()
+        if self.exporter is not None:
+            self.publish(time.time())
         print("=" * 80)
 
         self.batch_counter.reset()
@@ -166,6 +326,31 @@ class TrainLogger:
 
         self.epoch_counter.increment()
 
+    def publish(self, t):
+        elapsed = max(t - self.last_publish_time, 1e-9)
+        values = {
+            "epoch": self.epoch_counter.c,
+            "step": (self.epoch_counter.c - 1) * self.n_batches + self.batch_counter.c,
+            "samples": self.samples,
+            "samples_per_second": self.window_samples / elapsed,
+            "data_wait_fraction": min(self.window_data_time / elapsed, 1.0),
+        }
+
+        # meters are reset after each log, keep the last value until new updates arrive
+        for meter in self.meters:
+            current, epoch = self.meter_values.get(meter.name, (None, None))
+            if getattr(meter, "count", 1) > 0:
+                current = meter.get_current_value()
+            if getattr(meter, "epoch_count", 0) > 0:
+                epoch = meter.epoch_val / meter.epoch_count
+            self.meter_values[meter.name] = (current, epoch)
+
+        values.update(self.extra)
+        self.exporter.publish(values, dict(self.meter_values))
+        self.last_publish_time = t
+        self.window_samples = 0
+        self.window_data_time = 0.0
+
     def write_line(self, values):
         data = {
             "epoch": self.epoch_counter.c,
@@ -181,9 +366,19 @@ class TrainLogger:
 
     def log(self):
         entries = self._base_entries()
+        if "step_time_max" in self.extra:
+            entries.append(f"step {self.extra['step_time_min']:.3f}-{self.extra['step_time_max']:.3f}s "
+                           f"(slowest rank {self.extra['slowest_rank']})")
+        nonfinite = [k.split("/", 1)[1] for k, v in self.statistics.items() if k.startswith("nonfinite/") and v > 0]
+        if nonfinite:
+            entries.append(f"non-finite gradients in {', '.join(nonfinite)}")
         print('    '.join(entries))
 
-        self.write_line({meter.name: meter.get_current_value() for meter in self.meters})
+        values = {meter.name: meter.get_current_value() for meter in self.meters}
+        values.update(self.extra)
+        values.update(self.statistics)
+        self.statistics = dict()
+        self.write_line(values)
 
     def _base_entries(self):
         entries = [meter.to_str(self.epoch_counter.c, self.batch_counter.c) for meter in
@@ -195,4 +390,5 @@ class TrainLogger:
         print("    ".join([meter.header() for meter in [self.epoch_counter, self.batch_counter] + self.meters]))
 
     def __del__(self):
+        self.stop_exporter()
         self.log_file.close()
@@ -1,6 +1,11 @@
+import contextlib
+import itertools
 import os
 import re
 import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 import torch
@@ -9,11 +14,19 @@ import torch.jit
 import torch.multiprocessing as mp
 from omegaconf import OmegaConf
 
+from .autotune import apply_tuning, autotune
+from .costs import analyze_part, fmt_bytes, fmt_count, optimizer_states, print_part_costs
+from .ensemble import EnsemblePart, is_ensemble_state_dict
 from .logging import TrainLogger
-from .saver import ModelSaver
+from .pipeline import get_pipeline_stages
+from .saver import ModelSaver, load_checkpoint, resolve_checkpoint
+from .storage import LocalBackend
+from .store import BlobStore
 from .trainer import BaseTrainer
 
 USAGE = """usage"""
+# content addressed store of checkpoint tensors shared by all models of a model folder
+BLOBS_FOLDER = "blobs"
 
 
 def get_dtype(dtype):
@@ -32,21 +45,75 @@ def get_dtype(dtype):
     return torch.float
 
 
+def get_memory_format(memory_format):
+    if memory_format is None or memory_format == "contiguous":
+        return torch.contiguous_format
+
+    if memory_format == "channels_last":
+        return torch.channels_last
+
+    raise Exception(f"Unknown memory format '{memory_format}'")
+
+
+def get_compile_kwargs(compile_cfg):
+    """
+    `compile: true` uses the defaults, otherwise `compile: {mode: ..., dynamic: ..., backend: ...}`
+    """
+    kwargs = {"mode": "default", "dynamic": None, "backend": "inductor"}
+    if not isinstance(compile_cfg, bool):
+        for k in compile_cfg:
+            if k not in kwargs:
+                raise Exception(f"Unknown compile option '{k}', available options are {list(kwargs)}")
+            kwargs[k] = compile_cfg[k]
+
+    if kwargs["mode"] not in ("default", "reduce-overhead", "max-autotune"):
+        raise Exception(f"Unknown compile mode '{kwargs['mode']}'")
+
+    return kwargs
+
+
 def parse_shape(string, cfg):
     parts = [x.strip(" ") for x in string.strip("[]").split(",")]
     return [int(x) if x.isnumeric() else cfg.get(x.strip("'\"")) for x in parts]
 
 
+def parse_jit_inputs(jit_string, cfg):
+    """
+    Shapes and dtypes of the inputs of a part from its `jit` specification (e.g. "[batch_size, 1, 256, 256]@half")
+    """
+    return [(parse_shape(shape, cfg), get_dtype(dtype)) for shape, dtype in re.findall(r"(\[[^\]]+\])@?([^,]+)?",
+                                                                                      jit_string)]
+
+
+def get_device(device):
+    # integers are GPU indices, strings are device names (e.g. "cpu", "cuda:1")
+    if isinstance(device, int):
+        return torch.device("cuda", device)
+    return torch.device(device)
+
+
 def run_train(rank, this, *args):
     this._train(rank, *args)
 
 
+class DeferredPart:
+    """
+    Part whose construction has been deferred to the main thread, with its already read state dict
+    """
+
+    def __init__(self, state_dict):
+        self.state_dict = state_dict
+
+
 class Erlich:
-    def __init__(self, config_folder, model_folder, part_constructor, shared_file_path="/code/sharedfile"):
+    def __init__(self, config_folder, model_folder, part_constructor, shared_file_path="/code/sharedfile",
+                 storage=None):
         self.config_folder = config_folder
         self.model_folder = model_folder
         self.part_constructor = part_constructor
         self.shared_file_path = shared_file_path
+        # backend of the checkpoints (see `storage.py`), configurations and logs stay in `model_folder`
+        self.storage = storage if storage is not None else LocalBackend(model_folder)
 
     def config_from_cli(self):
         if len(sys.argv) < 2:
@@ -103,57 +170,166 @@ class Erlich:
         path = os.path.join(self.model_folder, model_id + ".yaml")
         return OmegaConf.load(path)
 
-    def instantiate_model_parts(self, cfg: OmegaConf, device, jit=True, load=True):
+    def weights_path(self, weights):
+        """
+        Checkpoint path and part name of a `weights` entry ("<model_id>.<part>[@<checkpoint>]")
+        """
+        if "@" in weights:
+            model_part, load_batch = weights.split("@")
+        else:
+            model_part, load_batch = weights, "latest"
+        model_id, load_part_name = model_part.split(".")
+
+        return resolve_checkpoint(self.storage, model_id, load_batch), load_part_name
+
+    def build_part(self, name, cfg, device, weights, timings, use_meta=True, defer_init=False):
+        """
+        Construct a part. When `weights` (a function returning a state dict) is given the part is constructed on the
+        meta device and its tensors are taken from the state dict instead of being initialized.
+        With `defer_init` (on worker threads) a part that needs the regular initialization, which uses the global RNG,
+        is not constructed: a `DeferredPart` holding its state dict is returned instead.
+        """
+        part = cfg.parts[name]
+        assert "arch" in part or "architecture" in part
+        arch = part.get("arch", part.get("architecture", None))
+        memory_format = get_memory_format(part.get("memory_format", None))
+        # frozen parts are shared by all the replicas of an ensemble
+        ensemble = cfg.get("ensemble", 1) if not part.get("frozen", False) else 1
+
+        t = time.perf_counter()
+        state_dict = weights() if weights is not None else None
+        timings["read"] = time.perf_counter() - t
+
+        # replicas of an ensemble loaded from the weights of a single model need their own copy of the tensors
+        meta = use_meta and state_dict is not None and (ensemble == 1 or is_ensemble_state_dict(state_dict))
+        if not meta and defer_init:
+            return DeferredPart(state_dict)
+
+        t = time.perf_counter()
+        with torch.device("meta") if meta else contextlib.nullcontext():
+            if ensemble > 1:
+                module = EnsemblePart([self.part_constructor(arch, part, cfg) for _ in range(ensemble)])
+            else:
+                module = self.part_constructor(arch, part, cfg)
+        timings["construct"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if meta:
+            module.load_state_dict(state_dict, assign=True)
+            if any(x.is_meta for x in itertools.chain(module.parameters(), module.buffers())):
+                # tensors missing from the state dict (e.g. non persistent buffers) need the regular initialization
+                print(f"WARNING: part '{name}' cannot be materialized from its state dict, initializing it")
+                if defer_init:
+                    return DeferredPart(state_dict)
+                return self.build_part(name, cfg, device, lambda: state_dict, timings, use_meta=False)
+            module = module.to(device, memory_format=memory_format)
+        else:
+            module = module.to(device, memory_format=memory_format)
+            if state_dict is not None:
+                if isinstance(module, EnsemblePart) and not is_ensemble_state_dict(state_dict):
+                    # all the replicas start from the same weights
+                    for replica in module.replicas:
+                        replica.load_state_dict(state_dict)
+                else:
+                    module.load_state_dict(state_dict)
+        timings["load"] = time.perf_counter() - t
+
+        return module
+
+    def instantiate_model_parts(self, cfg: OmegaConf, device, jit=True, load=True, compile_parts=True,
+                                checkpoint=None, names=None):
+        """
+        Build the model parts. Parts with weights (from their `weights` entry when `load`, or from `checkpoint`) are
+        constructed on the meta device, materialized from the memory mapped checkpoint and built concurrently.
+        Parts that are randomly initialized (even partially) are built in order on the main thread, so that their
+        initialization doesn't depend on scheduling.
+        `names` restricts the construction to some of the parts (e.g. the ones of a pipeline stage).
+        """
         parts_cfg = cfg.parts
+        names = list(parts_cfg) if names is None else [name for name in parts_cfg if name in names]
 
-        parts = dict()
+        weights = dict()
+        for name in names:
+            part = parts_cfg[name]
+            if checkpoint is not None and name in checkpoint["parts"]:
+                weights[name] = lambda name=name: checkpoint["parts"][name]
+            elif load and "weights" in part:
+                print(f"Part '{name}' loads weights from {part.weights}")
+                checkpoint_path, load_part_name = self.weights_path(part.weights)
+                weights[name] = lambda path=checkpoint_path, src=load_part_name: \
+                    load_checkpoint(path, map_location="cpu", mmap=True, backend=self.storage)["parts"][src]
 
-        for name in parts_cfg:
-            print(f"Instantiating model part '{name}'")
+        parts = dict()
+        timings = {name: dict() for name in names}
+        with ThreadPoolExecutor(max_workers=max(1, min(len(weights), os.cpu_count()))) as executor:
+            futures = {name: executor.submit(self.build_part, name, cfg, device, weights[name], timings[name],
+                                             defer_init=True)
+                       for name in weights}
+            for name in names:
+                if name not in weights:
+                    parts[name] = self.build_part(name, cfg, device, None, timings[name])
+            for name in futures:
+                parts[name] = futures[name].result()
+
+        # parts with weights that also need the regular initialization, after the other ones in a fixed order
+        for name in names:
+            if isinstance(parts[name], DeferredPart):
+                read_time = timings[name]["read"]
+                parts[name] = self.build_part(name, cfg, device, lambda sd=parts[name].state_dict: sd, timings[name],
+                                              use_meta=False)
+                timings[name]["read"] = read_time
+        parts = {name: parts[name] for name in names}
+
+        for name in names:
             part = parts_cfg[name]
-            assert "arch" in part or "architecture" in part
-            arch = part.get("arch", part.get("architecture", None))
+            memory_format = get_memory_format(part.get("memory_format", None))
+            t = time.perf_counter()
+            parts[name] = self.trace_part(name, parts[name], cfg, device, memory_format, jit, compile_parts)
+            timings[name]["jit/compile"] = time.perf_counter() - t
 
-            parts[name] = self.part_constructor(arch, part, cfg).to(device)
+        for name in names:
+            print(f"Instantiated model part '{name}': " +
+                  ", ".join(f"{k} {v:.2f}s" for k, v in timings[name].items()))
 
-            if load and "weights" in part:
-                print(f"    Loading weights from {part.weights}")
-                if "@" in part.weights:
-                    model_part, load_batch = part.weights.split("@")
-                else:
-                    model_part, load_batch = part.weights, "latest"
-                model_id, load_part_name = model_part.split(".")
+        return parts
 
-                checkpoint_path = os.path.join(self.model_folder, model_id, load_batch + ".pth")
-                checkpoint = torch.load(checkpoint_path, map_location=device)
+    def trace_part(self, name, module, cfg, device, memory_format, jit, compile_parts):
+        part = cfg.parts[name]
+        if "compile" in part and part["compile"] and compile_parts:
+            kwargs = get_compile_kwargs(part["compile"])
+            print(f"    Compiling with {kwargs}")
+            # compile in place: the module (and its state dict keys) stay the same, no `_orig_mod.` prefix
+            module.compile(**kwargs)
+            return module
 
-                parts[name].load_state_dict(checkpoint["parts"][load_part_name])
+        if "jit" in part and part["jit"] and jit and isinstance(module, EnsemblePart):
+            print("    JIT tracing is not supported for ensembles, skipping JIT")
+            return module
 
-            if "jit" in part and part["jit"] and jit:
-                jit_string = str(part["jit"])
-                print(jit_string)
+        if "jit" in part and part["jit"] and jit:
+            jit_string = str(part["jit"])
+            print(jit_string)
 
-                tensors = []
-                try:
-                    for shape, dtype in re.findall(r"(\[[^\]]+\])@?([^,]+)?", jit_string):
-                        dtype = get_dtype(dtype)
-                        shape = parse_shape(shape, cfg)
-                        print(f"    JIT tracing with input shape={shape} and dtype={dtype}")
-                        tensors.append(torch.zeros(*shape, dtype=dtype).to(device))
+            tensors = []
+            try:
+                for shape, dtype in parse_jit_inputs(jit_string, cfg):
+                    print(f"    JIT tracing with input shape={shape} and dtype={dtype}")
+                    tensor = torch.zeros(*shape, dtype=dtype).to(device)
+                    if tensor.dim() == 4:
+                        tensor = tensor.to(memory_format=memory_format)
+                    tensors.append(tensor)
 
-                except Exception as e:
-                    print(f"ERROR in parsing JIT shape for '{name}', skipping JIT\n", e)
-                    continue
+            except Exception as e:
+                print(f"ERROR in parsing JIT shape for '{name}', skipping JIT\n", e)
+                return module
 
-                parts[name] = torch.jit.trace_module(parts[name],
-                                                     {"forward": tensors})
+            module = torch.jit.trace_module(module, {"forward": tensors})
 
-        return parts
+        return module
 
     def model_actually_exists(self, mdl_id):
         yaml_path = os.path.join(self.model_folder, str(mdl_id) + ".yaml")
-        folder = os.path.join(self.model_folder, str(mdl_id))
-        return os.path.exists(yaml_path) and os.path.exists(folder) and len(os.listdir(folder)) > 0
+        return os.path.exists(yaml_path) and len(self.storage.list(f"{mdl_id}/")) > 0
 
     def list_models(self):
         files = glob(os.path.join(self.model_folder, "*.yaml"))
@@ -161,6 +337,71 @@ class Erlich:
         model_ids = list(filter(lambda x: self.model_actually_exists(x), model_ids))
         return model_ids
 
+    def collect_garbage(self, grace_period=3600):
+        """
+        Delete the blobs of the checkpoint store that are not referenced by any checkpoint (e.g. after deleting
+        checkpoints or models)
+        """
+        checkpoints = [k for k, _, _ in self.storage.list() if k.endswith(".pth") and k.count("/") == 1 and
+                       not k.startswith(BLOBS_FOLDER + "/")]
+        deleted, deleted_bytes = BlobStore(BLOBS_FOLDER, self.storage).gc(checkpoints, grace_period)
+        print(f"Deleted {deleted} blobs ({deleted_bytes / 2 ** 20:.1f} MiB)")
+        return deleted, deleted_bytes
+
+    def analyze(self, cfg, depth=2):
+        """
+        Print the parameters, FLOPs per sample and activation memory of each part (and of its modules up to `depth`)
+        at the batch size of the inputs of its `jit` specification, and estimate the memory needed to train it.
+        Parts are built on the meta device, no weights are allocated. Parts without `jit` only report parameters.
+        `cfg` is either a configuration or the name of one. Returns the costs of each part.
+        """
+        if isinstance(cfg, str):
+            cfg = self.parse_config(cfg, [])
+
+        results = dict()
+        totals = defaultdict(float)
+        for name in cfg.parts:
+            part = cfg.parts[name]
+            arch = part.get("arch", part.get("architecture", None))
+            with torch.device("meta"):
+                module = self.part_constructor(arch, part, cfg)
+
+            trainable = not part.get("frozen", False)
+            if trainable:
+                module.train()
+            else:
+                module.requires_grad_(False)
+                module.eval()
+
+            inputs = [torch.zeros(shape, dtype=dtype, device="meta")
+                      for shape, dtype in parse_jit_inputs(str(part["jit"]), cfg)] if "jit" in part else []
+            if not inputs:
+                print(f"Part '{name}' has no `jit` input shapes, only counting its parameters")
+            costs = analyze_part(module, inputs, trainable, depth)
+
+            states = optimizer_states(part.optimizer if "optimizer" in part else cfg.get("optimizer", dict()))
+            costs["optimizer_bytes"] = states * costs["trainable_bytes"] if states is not None else None
+            print_part_costs(name, costs)
+            print(f"    params {fmt_count(costs['params'])} ({fmt_count(costs['trainable_params'])} trainable), "
+                  f"forward {fmt_count(costs['forward_flops'])}FLOP, backward {fmt_count(costs['backward_flops'])}FLOP")
+            print(f"    memory: weights {fmt_bytes(costs['param_bytes'])}, "
+                  f"gradients {fmt_bytes(costs['trainable_bytes'])}, optimizer state " +
+                  (fmt_bytes(costs["optimizer_bytes"]) if states is not None else "unknown") +
+                  f", activations {fmt_bytes(costs['activation_bytes'])}")
+            print("")
+
+            for k in ["params", "forward_flops", "backward_flops", "param_bytes", "trainable_bytes", "activation_bytes"]:
+                totals[k] += costs[k]
+            totals["optimizer_bytes"] += costs["optimizer_bytes"] or 0
+            results[name] = costs
+
+        print(f"Total: params {fmt_count(totals['params'])}, forward {fmt_count(totals['forward_flops'])}FLOP, "
+              f"backward {fmt_count(totals['backward_flops'])}FLOP, estimated training memory " +
+              fmt_bytes(totals["param_bytes"] + totals["trainable_bytes"] + totals["optimizer_bytes"] +
+                        totals["activation_bytes"]))
+
+        return results
+
     def get_next_id(self):
         models = self.list_models()
         if models:
@@ -175,7 +416,7 @@ class Erlich:
         "0" --> (model_id=0, batch="latest", ...)
         "1@0.100" --> (model_id=1, batch="0.100", ...)
         :param checkpoint_name: Name of the checkpoint
-        :return: ID of the model, batch, path of the checkpoint
+        :return: ID of the model, batch, key of the checkpoint in the storage backend
         """
 
         if "@" in checkpoint_name:
@@ -183,13 +424,12 @@ class Erlich:
         else:
             model_id, load_batch = checkpoint_name, "latest"
 
-        checkpoint_path = os.path.join(self.model_folder, model_id, load_batch + ".pth")
+        checkpoint_path = resolve_checkpoint(self.storage, model_id, load_batch)
 
         return model_id, load_batch, checkpoint_path
 
-    @staticmethod
-    def load_state_dicts(model_parts, checkpoint_path, device):
-        checkpoint = torch.load(checkpoint_path, map_location=device)
+    def load_state_dicts(self, model_parts, checkpoint_path, device):
+        checkpoint = load_checkpoint(checkpoint_path, map_location=device, backend=self.storage)
         for k in checkpoint["parts"]:
             print("Loading model part", k)
             model_parts[k].load_state_dict(checkpoint["parts"][k])
@@ -202,47 +442,107 @@ class Erlich:
         return model_parts, cfg
 
     def load_model(self, checkpoint_name, device, jit=False):
-        model_id, _, checkpoint_path = self.get_checkpoint(checkpoint_name)
+        model_id, load_batch, checkpoint_path = self.get_checkpoint(checkpoint_name)
         cfg = self.read_model_config(model_id)
+        # checkpoint of a single replica of an ensemble, see `ModelSaver.split_replicas`
+        if re.search(r"\.r\d+$", load_batch):
+            cfg["ensemble"] = 1
+
+        checkpoint = load_checkpoint(checkpoint_path, map_location="cpu", mmap=True, backend=self.storage)
+        model_parts = self.instantiate_model_parts(cfg, device, jit=jit, load=False, checkpoint=checkpoint)
+
+        # precision used in training, use it for inference with `precision_autocast(cfg.precision, device)`
+        trainer_state = checkpoint.get("trainer")
+        if trainer_state is not None and "precision" in trainer_state:
+            cfg["precision"] = trainer_state["precision"]
 
-        model_parts = self.instantiate_model_parts(cfg, device, jit=jit, load=False)
-        self.load_state_dicts(model_parts, checkpoint_path, device)
         return model_parts, cfg
 
-    def _train(self, rank, world_size, devices, trainer_class, cfg, mdl_id, mdl_path, validate_every, logger_min_wait):
+    def _train(self, rank, world_size, devices, trainer_class, cfg, mdl_id, mdl_path, validate_every, logger_min_wait,
+               resume_checkpoint=None):
+        device = get_device(devices[rank])
+
         if world_size > 1:
             # initialize the process group
-            dist.init_process_group("nccl", init_method=f"file://{self.shared_file_path}", rank=rank,
+            dist.init_process_group("nccl" if device.type == "cuda" else "gloo",
+                                    init_method=f"file://{self.shared_file_path}", rank=rank,
                                     world_size=world_size)
 
         # Explicitly setting seed to make sure that models created in two processes
         # start from same random weights and biases.
-        torch.manual_seed(42)
+        torch.manual_seed(cfg.get("seed", 42))
 
-        device = torch.device("cuda", devices[rank])
         if world_size > 1:
-            print(f"Spawned trainer process {rank} that will use GPU device '{device}'")
+            print(f"Spawned trainer process {rank} that will use device '{device}'")
         else:
-            print(f"Training on main process using GPU device '{device}'")
+            print(f"Training on main process using device '{device}'")
 
         if rank == 0:
             print("=" * 20, "INSTANTIATING MODEL FOR TRAINING", "=" * 20)
 
-            # instantiate logger and saver
-            logger = TrainLogger(mdl_path + ".log", cfg.epochs)
-            saver = ModelSaver(mdl_path)
+            # instantiate logger and saver, when resuming keep logging to the same file
+            logger = TrainLogger(mdl_path + ".log", cfg.epochs, append=resume_checkpoint is not None)
+            # tensors of the checkpoints can be stored once in a store shared by all models
+            store = BlobStore(BLOBS_FOLDER, self.storage) if cfg.get("dedup_checkpoints", False) else None
+            saver = ModelSaver(mdl_path, store, self.storage, mdl_id)
         else:
             logger = None
             saver = None
 
-        model_parts = self.instantiate_model_parts(cfg, device)
+        # when resuming the parts are materialized directly from the checkpoint
+        checkpoint = load_checkpoint(resume_checkpoint, map_location="cpu", mmap=True, backend=self.storage) \
+            if resume_checkpoint is not None else None
+        # with pipeline parallelism each rank builds only the parts of its stage
+        stage_parts = get_pipeline_stages(cfg, world_size)[rank] if cfg.get("pipeline", False) else None
+        model_parts = self.instantiate_model_parts(cfg, device, load=resume_checkpoint is None, checkpoint=checkpoint,
+                                                   names=stage_parts)
 
         # create model trainer
         trainer = trainer_class(cfg, model_parts, saver, logger, device, rank, world_size)
         assert isinstance(trainer, BaseTrainer)
+        trainer.model_path = mdl_path
+
+        trainer.create_dataloaders()
+
+        # instantiate optimizers
+        print("Instantiating optimizers")
+        trainer.instantiate_optimizers(cfg)
+
+        if cfg.get("autotune", False) and stage_parts is not None:
+            # a stage cannot run a training step on its own
+            print("Autotuning is not supported with pipeline parallelism, skipping it")
+        elif cfg.get("autotune", False) and resume_checkpoint is None:
+            tuned = autotune(trainer, cfg) if rank == 0 else None
+            if world_size > 1:
+                # every rank uses the values chosen by rank 0
+                tuned = [tuned]
+                dist.broadcast_object_list(tuned, src=0, device=device)
+                tuned = tuned[0]
+            apply_tuning(trainer, tuned)
+
+            # write the chosen values in the saved model configuration
+            if rank == 0:
+                OmegaConf.save(cfg, mdl_path + ".yaml")
+
+        if cfg.get("shard_optimizer_state", False) and world_size > 1:
+            print("Sharding optimizer states across ranks")
+            trainer.shard_optimizers()
+
+        # sharded optimizers load the full (consolidated) state and keep their partition
+        if resume_checkpoint is not None:
+            print("Resuming from checkpoint", resume_checkpoint)
+            if checkpoint.get("trainer") is None:
+                raise Exception(f"Checkpoint '{resume_checkpoint}' doesn't contain the trainer state, cannot resume")
+
+            for k in checkpoint["optimizers"]:
+                if stage_parts is not None and k not in trainer.optimizers:
+                    continue
+                trainer.optimizers[k].load_state_dict(checkpoint["optimizers"][k])
+            trainer.load_state_dict(checkpoint["trainer"])
+            print(f"Resuming training at epoch {trainer.start_epoch} batch {trainer.start_batch}")
 
         # load checkpoint
-        if "load_checkpoint" in cfg:
+        elif "load_checkpoint" in cfg:
             print("Loading checkpoint", str(cfg["load_checkpoint"]))
             _, _, checkpoint_path = self.get_checkpoint(str(cfg["load_checkpoint"]))
             print("Checkpoint path", checkpoint_path)
@@ -256,13 +556,33 @@ class Erlich:
             # if "amp" in checkpoint and checkpoint["amp"] is not None:
             #     amp.load_state_dict(checkpoint["amp"])
 
-        trainer.create_dataloaders()
+        trainer.train(validate_every, logger_min_wait, distributed_data_parallel=world_size > 1)
 
-        # instantiate optimizers
-        print("Instantiating optimizers")
-        trainer.instantiate_optimizers(cfg)
+        if trainer.interrupted:
+            if world_size > 1:
+                # wait for rank 0 to write the checkpoint
+                dist.barrier()
+                dist.destroy_process_group()
+            print(f"Training of model {mdl_id} interrupted, resume it with `resume(\"{mdl_id}\")`")
+            sys.exit(0)
 
-        trainer.train(validate_every, logger_min_wait, distributed_data_parallel=world_size > 1)
+    def _launch(self, trainer_class, cfg, devices, mdl_id, mdl_path, validate_every, logger_min_wait,
+                resume_checkpoint=None):
+        world_size = len(devices)
+
+        if world_size > 1:
+            while os.path.exists(self.shared_file_path):
+                print("WARN", self.shared_file_path, "already exists, trying a different one")
+                self.shared_file_path = self.shared_file_path + "_"
+            mp.spawn(run_train,
+                     args=(
+                         self, world_size, devices, trainer_class, cfg, mdl_id, mdl_path, validate_every,
+                         logger_min_wait, resume_checkpoint),
+                     nprocs=world_size,
+                     join=True)
+        else:
+            self._train(0, 1, devices, trainer_class, cfg, mdl_id, mdl_path, validate_every, logger_min_wait,
+                        resume_checkpoint)
 
     def train(self, trainer_class, cfg, devices, validate_every=-1, logger_min_wait=5):
         print("=" * 20, "MODEL CONFIG", "=" * 20)
@@ -285,17 +605,19 @@ class Erlich:
         # save config
         OmegaConf.save(cfg, cfg_path)
 
-        world_size = len(devices)
+        self._launch(trainer_class, cfg, devices, mdl_id, mdl_path, validate_every, logger_min_wait)
 
-        if world_size > 1:
-            while os.path.exists(self.shared_file_path):
-                print("WARN", self.shared_file_path, "already exists, trying a different one")
-                self.shared_file_path = self.shared_file_path + "_"
-            mp.spawn(run_train,
-                     args=(
-                         self, world_size, devices, trainer_class, cfg, mdl_id, mdl_path, validate_every,
-                         logger_min_wait),
-                     nprocs=world_size,
-                     join=True)
-        else:
-            self._train(0, 1, devices, trainer_class, cfg, mdl_id, mdl_path, validate_every, logger_min_wait)
+    def resume(self, trainer_class, checkpoint_name, devices, validate_every=-1, logger_min_wait=5):
+        """
+        Continue an interrupted training of the same model from the exact epoch and batch of a checkpoint.
+        Examples of checkpoint names: "3" (latest checkpoint of model 3), "3@1.500"
+        """
+        mdl_id, _, checkpoint_path = self.get_checkpoint(checkpoint_name)
+        cfg = self.read_model_config(mdl_id)
+        mdl_path = os.path.join(self.model_folder, mdl_id)
+
+        print("=" * 20, "RESUMING MODEL", mdl_id, "=" * 20)
+        print(OmegaConf.to_yaml(cfg))
+
+        self._launch(trainer_class, cfg, devices, mdl_id, mdl_path, validate_every, logger_min_wait,
+                     checkpoint_path)
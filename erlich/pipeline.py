@@ -0,0 +1,253 @@
+"""
+Pipeline parallel training across processes.
+
+The parts of the model are split in consecutive stages, each rank builds and trains only the parts of its stage.
+A batch is split in micro-batches that flow through the stages: the outputs of the last part of a stage are sent to
+the next rank, which sends back their gradients. Micro-batches are scheduled as in GPipe (all forwards, then all
+backwards) or 1F1B (one forward, one backward once the pipeline is full, which keeps fewer activations alive).
+Each stage steps its own optimizers, the gradients are the ones of the whole batch (losses are averaged over the
+micro-batches).
+"""
+import contextlib
+
+import torch
+import torch.distributed as dist
+
+FORWARD_TAG = 0
+BACKWARD_TAG = 1
+# dtypes of the tensors exchanged between stages, sent as their index in this list
+DTYPES = [torch.float32, torch.float16, torch.bfloat16, torch.float64, torch.int64, torch.int32, torch.int16,
+          torch.int8, torch.uint8, torch.bool]
+SCHEDULES = ["gpipe", "1f1b"]
+
+
+def get_pipeline_stages(cfg, n_stages):
+    """
+    Names of the parts of each stage, from `pipeline.stages` (a list of part names, or lists of part names, in
+    forward order) or by splitting the parts of the configuration in `n_stages` groups of consecutive parts
+    """
+    pipeline_cfg = cfg.pipeline if not isinstance(cfg.pipeline, bool) else dict()
+    names = list(cfg.parts)
+
+    stages = pipeline_cfg.get("stages", None)
+    if stages is None:
+        if n_stages > len(names):
+            raise Exception(f"Cannot split {len(names)} parts in {n_stages} pipeline stages")
+        size, rest = divmod(len(names), n_stages)
+        bounds = [i * size + min(i, rest) for i in range(n_stages + 1)]
+        stages = [names[bounds[i]:bounds[i + 1]] for i in range(n_stages)]
+
+    stages = [[stage] if isinstance(stage, str) else list(stage) for stage in stages]
+    if len(stages) != n_stages:
+        raise Exception(f"Pipeline has {len(stages)} stages but training runs on {n_stages} processes")
+
+    staged = [name for stage in stages for name in stage]
+    if sorted(staged) != sorted(names):
+        raise Exception(f"Every part must belong to exactly one pipeline stage, got stages {stages} for parts {names}")
+
+    return stages
+
+
+def as_tuple(x):
+    return tuple(x) if isinstance(x, (tuple, list)) else (x,)
+
+
+def split_microbatches(x, n):
+    if isinstance(x, torch.Tensor):
+        return list(torch.tensor_split(x, n))
+    if isinstance(x, (tuple, list)):
+        return [type(x)(y) for y in zip(*[split_microbatches(y, n) for y in x])]
+    # non tensor values (e.g. None) are shared by all the micro-batches
+    return [x] * n
+
+
+def to_cpu(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu()
+    if isinstance(x, dict):
+        return {k: to_cpu(v) for k, v in x.items()}
+    if isinstance(x, (tuple, list)):
+        return type(x)(to_cpu(y) for y in x)
+    return x
+
+
+class Pipeline:
+    def __init__(self, parts, stage, n_stages, device, microbatches=None, schedule="1f1b"):
+        """
+        `parts` are the modules of this stage in forward order, the inputs of each part are the outputs of the
+        previous one (a tuple is unpacked into positional arguments)
+        """
+        if schedule not in SCHEDULES:
+            raise Exception(f"Unknown pipeline schedule '{schedule}', choose one of {SCHEDULES}")
+
+        self.parts = parts
+        self.stage = stage
+        self.n_stages = n_stages
+        self.device = torch.device(device)
+        # enough micro-batches to keep every stage busy most of the time
+        self.microbatches = microbatches if microbatches is not None else 2 * n_stages
+        self.schedule = schedule
+
+        # NCCL only exchanges device tensors, gloo only CPU tensors
+        nccl = dist.is_initialized() and dist.get_backend() == "nccl"
+        self.comm_device = self.device if nccl else torch.device("cpu")
+
+        # pending sends and the tensors they use, which must stay alive until completion
+        self.requests = []
+
+    @property
+    def is_first(self):
+        return self.stage == 0
+
+    @property
+    def is_last(self):
+        return self.stage == self.n_stages - 1
+
+    def run_parts(self, x):
+        for part in self.parts:
+            x = part(*as_tuple(x))
+        return x
+
+    def send(self, tensors, dst, tag):
+        """
+        Send a list of tensors without waiting, preceded by a header with their dtypes and shapes
+        """
+        header = [len(tensors)]
+        for t in tensors:
+            header += [DTYPES.index(t.dtype), t.dim(), *t.shape]
+
+        header = torch.tensor(header, dtype=torch.int64, device=self.comm_device)
+        length = torch.tensor([len(header)], dtype=torch.int64, device=self.comm_device)
+        for t in [length, header] + [t.detach().to(self.comm_device).contiguous() for t in tensors]:
+            self.requests.append((dist.isend(t, dst, tag=tag), t))
+
+    def recv(self, src, tag):
+        length = torch.zeros(1, dtype=torch.int64, device=self.comm_device)
+        dist.recv(length, src, tag=tag)
+        header = torch.zeros(int(length.item()), dtype=torch.int64, device=self.comm_device)
+        dist.recv(header, src, tag=tag)
+        header = header.tolist()
+
+        tensors, pos = [], 1
+        for _ in range(header[0]):
+            dtype, ndim = DTYPES[header[pos]], header[pos + 1]
+            t = torch.empty(header[pos + 2:pos + 2 + ndim], dtype=dtype, device=self.comm_device)
+            dist.recv(t, src, tag=tag)
+            tensors.append(t.to(self.device))
+            pos += 2 + ndim
+
+        return tensors
+
+    def wait(self):
+        for request, _ in self.requests:
+            request.wait()
+        self.requests = []
+
+    def steps(self, n):
+        """
+        Order in which this stage runs the forward ("f") and backward ("b") passes of `n` micro-batches
+        """
+        if self.schedule == "gpipe":
+            return [("f", m) for m in range(n)] + [("b", m) for m in range(n)]
+
+        # 1F1B: the forwards needed to fill the pipeline downstream, then alternate, then drain
+        warmup = min(self.n_stages - self.stage - 1, n)
+        steps = [("f", m) for m in range(warmup)]
+        for m in range(n - warmup):
+            steps += [("f", warmup + m), ("b", m)]
+        steps += [("b", m) for m in range(n - warmup, n)]
+        return steps
+
+    def train_step(self, inputs, target, loss_fn, batch_size, autocast=contextlib.nullcontext):
+        """
+        Forward and backward of a batch, every stage must call it with the same `batch_size`. `inputs` are only
+        used by the first stage, `target` and `loss_fn(output, target)` by the last one.
+        Returns the loss of the batch (on every stage), gradients are accumulated in the parameters of the parts.
+        """
+        n = max(1, min(self.microbatches, batch_size))
+        inputs = split_microbatches(as_tuple(inputs), n) if self.is_first else None
+        targets = split_microbatches(target, n) if self.is_last else None
+
+        saved = dict()
+        losses = []
+        for kind, m in self.steps(n):
+            if kind == "f":
+                if self.is_first:
+                    x = inputs[m]
+                else:
+                    x = self.recv(self.stage - 1, FORWARD_TAG)
+                    for t in x:
+                        t.requires_grad_(t.is_floating_point())
+
+                with autocast():
+                    output = self.run_parts(x)
+                    if self.is_last:
+                        # mean over the micro-batches, like the loss of the whole batch
+                        output = loss_fn(output, targets[m]) / n
+                        losses.append(output.detach())
+
+                if not self.is_last:
+                    output = as_tuple(output)
+                    self.send(list(output), self.stage + 1, FORWARD_TAG)
+                saved[m] = (x, output)
+            else:
+                x, output = saved.pop(m)
+                if self.is_last:
+                    output.backward()
+                else:
+                    grads = self.recv(self.stage + 1, BACKWARD_TAG)
+                    pairs = [(o, g) for o, g in zip(output, grads) if o.requires_grad]
+                    if pairs:
+                        torch.autograd.backward([o for o, _ in pairs], [g for _, g in pairs])
+
+                if not self.is_first:
+                    self.send([t.grad if t.grad is not None else torch.zeros_like(t) for t in x],
+                              self.stage - 1, BACKWARD_TAG)
+
+        self.wait()
+
+        loss = torch.stack(losses).sum() if self.is_last else torch.zeros((), device=self.device)
+        if self.n_stages > 1:
+            loss = loss.to(self.comm_device)
+            dist.broadcast(loss, src=self.n_stages - 1)
+        return loss.to(self.device)
+
+    def forward(self, inputs):
+        """
+        Forward only pass of a batch (e.g. for validation), returns the output on the last stage and None elsewhere
+        """
+        x = inputs if self.is_first else self.recv(self.stage - 1, FORWARD_TAG)
+        output = self.run_parts(x)
+        if self.is_last:
+            return output
+
+        self.send(list(as_tuple(output)), self.stage + 1, FORWARD_TAG)
+        self.wait()
+        return None
+
+    def broadcast_object(self, obj):
+        """
+        Object of the last stage (e.g. validation metrics) on every stage
+        """
+        if self.n_stages == 1:
+            return obj
+        objects = [obj]
+        dist.broadcast_object_list(objects, src=self.n_stages - 1, device=self.comm_device)
+        return objects[0]
+
+    def gather(self, *dicts):
+        """
+        Merge on rank 0 the dicts of all the stages (e.g. state dicts of their parts), tensors are moved to CPU.
+        Returns None on the other ranks.
+        """
+        dicts = to_cpu(dicts)
+        if self.n_stages == 1:
+            return dicts
+
+        gathered = [None] * self.n_stages if self.is_first else None
+        dist.gather_object(dicts, gathered, dst=0)
+        if not self.is_first:
+            return None
+
+        return tuple({k: v for stage_dicts in gathered for k, v in stage_dicts[i].items()}
+                     for i in range(len(dicts)))
@@ -0,0 +1,49 @@
+import signal
+
+import torch
+import torch.distributed as dist
+
+
+class PreemptionHandler:
+    """
+    Records the reception of termination signals so that the trainer can save a checkpoint
+    at the next step boundary and exit cleanly instead of being killed in the middle of a step.
+    In distributed runs the ranks agree on stopping every `check_every` steps, which needs a collective.
+    """
+
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGUSR1), check_every=10):
+        self.signals = signals
+        self.received = None
+        self.previous_handlers = dict()
+        self.check_every = max(1, check_every)
+        self.steps = 0
+
+    def handler(self, signum, frame):
+        self.received = signum
+
+    def install(self):
+        for s in self.signals:
+            self.previous_handlers[s] = signal.signal(s, self.handler)
+
+    def uninstall(self):
+        for s in self.previous_handlers:
+            signal.signal(s, self.previous_handlers[s])
+        self.previous_handlers = dict()
+
+    def should_stop(self, device, distributed=False):
+        """
+        Called by every rank after each step
+        """
+        stop = self.received is not None
+        self.steps += 1
+
+        # the signal may have reached only some ranks, all of them must stop at the same step
+        if distributed:
+            if self.steps % self.check_every != 0:
+                return False
+
+            flag = torch.tensor([int(stop)], device=device)
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            stop = flag.item() > 0
+
+        return stop
@@ -1,41 +1,150 @@
 import json
 import os
+import posixpath
+import threading
 import time
-from glob import glob
 
 import torch
 
+from .ensemble import replica_checkpoint
+from .storage import LocalBackend
+from .store import BlobStore, MANIFEST_FORMAT
+
+# pointer to the latest checkpoint of a model: its info with the name of the checkpoint
+LATEST = "latest"
+
+
+def load_checkpoint(path, map_location=None, mmap=False, backend=None):
+    """
+    Load a checkpoint saved either as a single file or as a manifest of a BlobStore. `path` is a key of `backend`
+    (by default a path of the local filesystem).
+    With `mmap` tensors are memory mapped from the files instead of being read.
+    """
+    backend = backend if backend is not None else LocalBackend()
+    checkpoint = torch.load(backend.local_path(path), map_location=map_location, mmap=mmap)
+    if isinstance(checkpoint, dict) and checkpoint.get("format") == MANIFEST_FORMAT:
+        # the store path is relative to the folder of the checkpoint
+        store_path = posixpath.normpath(posixpath.join(posixpath.dirname(path), checkpoint["store"]))
+        store = BlobStore(store_path, backend)
+        checkpoint = {k: store.from_manifest(v, map_location, mmap) for k, v in checkpoint.items()
+                      if k not in ["format", "store"]}
+
+    return checkpoint
+
+
+def resolve_checkpoint(backend, folder, name):
+    """
+    Key of the checkpoint `name` (e.g. "0.100" or "latest") in the model folder `folder` of `backend`
+    """
+    if name == LATEST:
+        info_key = posixpath.join(folder, f"{LATEST}.json")
+        if backend.exists(info_key):
+            # model folders saved before the pointer have a `latest.pth` link instead
+            name = json.loads(backend.read_bytes(info_key)).get("checkpoint", LATEST)
+
+    return posixpath.join(folder, f"{name}.pth")
+
 
 class ModelSaver:
-    def __init__(self, base_path):
+    def __init__(self, base_path, store=None, backend=None, prefix=None):
         if not os.path.exists(base_path):
             os.mkdir(base_path)
         self.base_path = base_path
+        # optional BlobStore deduplicating tensors across checkpoints
+        self.store = store
+        # checkpoints are stored in `backend` under `prefix`, by default in the `base_path` folder
+        self.backend = backend if backend is not None else LocalBackend()
+        self.prefix = prefix if prefix is not None else base_path
+        # infos and the latest pointer are updated by the training loop and by the asynchronous validation
+        self.info_lock = threading.Lock()
+
+    def key(self, name):
+        return posixpath.join(self.prefix, name)
+
+    def write_info(self, path, info):
+        self.backend.write_bytes(f"{path}.json", json.dumps(info, indent=2).encode())
 
-    @staticmethod
-    def link(link_path, src_path):
-        if os.path.exists(link_path):
-            os.unlink(link_path)
-        os.symlink(src_path, link_path)
+    def read_info(self, path):
+        return json.loads(self.backend.read_bytes(f"{path}.json"))
 
-    def save(self, parts, optimizers, epoch, batch, metrics):
-        path = os.path.join(self.base_path, f"{epoch}.{batch}")
-        latest_path = os.path.join(self.base_path, "latest")
+    def save_metrics(self, epoch, batch, metrics):
+        """
+        Set the metrics of an already saved checkpoint (e.g. computed by asynchronous validation)
+        """
+        name = f"{epoch}.{batch}"
+        with self.info_lock:
+            info = self.read_info(self.key(name))
+            info["metrics"] = metrics
+            self.write_info(self.key(name), info)
+
+            latest = self.read_info(self.key(LATEST))
+            if latest.get("checkpoint") == name:
+                self.write_info(self.key(LATEST), dict(info, checkpoint=name))
+
+    def save(self, parts, optimizers, epoch, batch, metrics, trainer_state=None):
+        self.save_state({k: parts[k].state_dict() for k in parts}, {k: optimizers[k].state_dict() for k in optimizers},
+                        epoch, batch, metrics, trainer_state)
+
+    def save_state(self, parts, optimizers, epoch, batch, metrics, trainer_state=None):
+        """
+        Like `save` but with the state dicts of the parts and optimizers (e.g. gathered from other ranks)
+        """
+        name = f"{epoch}.{batch}"
+        path = self.key(name)
         print(f"Saving model checkpoint at '{path}'")
 
-        torch.save({
-            "parts": {k: parts[k].state_dict() for k in parts},
-            "optimizers": {k: optimizers[k].state_dict() for k in optimizers},
-        }, f"{path}.pth")
-
-        with open(f"{path}.json", "w") as f:
-            json.dump({
-                "epoch": epoch,
-                "batch": batch,
-                "time": time.time(),
-                "metrics": metrics
-            }, f, indent=2)
-
-        # link latest checkpoint for easy reuse
-        self.link(f"{latest_path}.json", f"{os.path.basename(path)}.json")
-        self.link(f"{latest_path}.pth", f"{os.path.basename(path)}.pth")
\ No newline at end of file
+        self.write_checkpoint(f"{path}.pth", {
+            "parts": parts,
+            "optimizers": optimizers,
+            "trainer": trainer_state,
+        })
+
+        info = {
+            "epoch": epoch,
+            "batch": batch,
+            "time": time.time(),
+            "metrics": metrics
+        }
+        with self.info_lock:
+            self.write_info(path, info)
+            # the latest pointer is an object written after the checkpoint, not a link
+            self.write_info(self.key(LATEST), dict(info, checkpoint=name))
+        # link of model folders saved before the pointer, it would point to an older checkpoint
+        if self.backend.exists(self.key(f"{LATEST}.pth")):
+            self.backend.delete(self.key(f"{LATEST}.pth"))
+
+    def write_checkpoint(self, path, checkpoint):
+        if self.store is not None:
+            self.store.written_bytes = 0
+            manifest = self.store.to_manifest(checkpoint)
+            manifest["format"] = MANIFEST_FORMAT
+            manifest["store"] = posixpath.relpath(self.store.path, posixpath.dirname(path))
+            checkpoint = manifest
+            print(f"    {self.store.written_bytes / 2 ** 20:.1f} MiB of new blobs")
+
+        # serialized and written in parallel chunks
+        with self.backend.open_write(path) as f:
+            torch.save(checkpoint, f)
+
+    def split_replicas(self, name, ensemble):
+        """
+        Write a checkpoint for each replica of an ensemble checkpoint (e.g. "latest" -> "latest.r0", "latest.r1", ...),
+        in the same format of a model trained without ensemble
+        """
+        path = self.key(name)
+        checkpoint = load_checkpoint(resolve_checkpoint(self.backend, self.prefix, name), map_location="cpu",
+                                     backend=self.backend)
+        info = self.read_info(path)
+
+        replica_paths = []
+        for replica in range(ensemble):
+            replica_path = f"{path}.r{replica}"
+            self.write_checkpoint(f"{replica_path}.pth", replica_checkpoint(checkpoint, replica))
+
+            suffix = f"@{replica}"
+            metrics = info.get("metrics") or dict()
+            self.write_info(replica_path, dict(info, metrics={k[:-len(suffix)]: v for k, v in metrics.items()
+                                                              if k.endswith(suffix)}))
+            replica_paths.append(replica_path)
+
+        return replica_paths
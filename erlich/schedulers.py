@@ -18,12 +18,21 @@ class LRScheduler:
     def step(self, loss_value=0.0, size=1):
         self.count += size
 
-        self.lr = self.compute_lr(self.count, loss_value)
+        self.lr = float(self.compute_lr(self.count, loss_value))
         for param_group in self.optimizer.param_groups:
             param_group['lr'] = self.lr
 
         return self.lr
 
+    def state_dict(self):
+        return {"count": self.count, "lr": self.lr}
+
+    def load_state_dict(self, state_dict):
+        self.count = state_dict["count"]
+        self.lr = state_dict["lr"]
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] = self.lr
+
 
 class WarmupScheduler(LRScheduler):
     def __init__(self, optimizer, lr, warmup_batches=500):
@@ -68,28 +77,63 @@ class WarmupPlateauScheduler(LRScheduler):
         self.patience = patience
         self.patience_count = 0
 
-        xx = (np.arange(self.plateau_size, dtype=np.float32) - self.plateau_size).reshape(1, -1)
-        A = np.vstack((xx, np.ones(self.plateau_size)))
-        self.A = np.linalg.pinv(A)
-        self.loss_values = []
+        # the last `plateau_size` loss values are kept in a ring buffer, the line fit is maintained incrementally
+        # from the running sums of y and x*y, where x goes from -plateau_size (oldest) to -1 (newest)
+        self.xx = np.arange(self.plateau_size, dtype=np.float64) - self.plateau_size
+        self.sum_x = float(np.sum(self.xx))
+        self.sum_xx = float(np.dot(self.xx, self.xx))
+        self.loss_values = np.zeros(self.plateau_size, dtype=np.float64)
+        self.head = 0
+        self.n_values = 0
+        self.sum_y = 0.0
+        self.sum_xy = 0.0
 
         super().__init__(optimizer)
 
+    def reset_loss_values(self):
+        self.head = 0
+        self.n_values = 0
+        self.sum_y = 0.0
+        self.sum_xy = 0.0
+
+    def add_loss_value(self, loss_value: float):
+        # every value already in the window moves one position back (x -> x - 1), the new one goes to x = -1
+        self.sum_xy -= self.sum_y + loss_value
+        self.sum_y += loss_value
+
+        if self.n_values == self.plateau_size:
+            # the oldest value has been pushed to x = -plateau_size - 1, drop it
+            oldest = self.loss_values[self.head]
+            self.sum_xy += (self.plateau_size + 1) * oldest
+            self.sum_y -= oldest
+        else:
+            self.n_values += 1
+
+        self.loss_values[self.head] = loss_value
+        self.head = (self.head + 1) % self.plateau_size
+
+        # once per lap the buffer is ordered from oldest to newest: recompute the sums to avoid drift
+        if self.head == 0 and self.n_values == self.plateau_size:
+            self.sum_y = float(np.sum(self.loss_values))
+            self.sum_xy = float(np.dot(self.xx, self.loss_values))
+
+    def fit_line(self):
+        n = self.plateau_size
+        m = (n * self.sum_xy - self.sum_x * self.sum_y) / (n * self.sum_xx - self.sum_x ** 2)
+        b = (self.sum_y - m * self.sum_x) / n
+        return m, b
+
     def compute_lr(self, step: int, loss_value: float):
         # accumulate loss values
-        self.loss_values.append(loss_value)
-        if len(self.loss_values) > self.plateau_size:
-            self.loss_values = self.loss_values[-self.plateau_size:]
+        self.add_loss_value(float(loss_value))
 
         # first batches do LR warmup
         if step <= self.warmup_batches:
             return self.initial_lr * (np.exp((step / self.warmup_batches)) - 1) / (np.exp(1) - 1)
         else:
             # if has enough loss values fit a line to see if the loss is decreasing
-            if len(self.loss_values) == self.plateau_size:
-                x = np.asarray(self.loss_values).reshape(1, -1)
-                mb = np.dot(x, self.A)
-                m, b = mb[0, 0], mb[0, 1]
+            if self.n_values == self.plateau_size:
+                m, b = self.fit_line()
 
                 # if loss is not decreasing enough increase patience count
                 relative_delta = m / abs(b)
@@ -101,7 +145,27 @@ class WarmupPlateauScheduler(LRScheduler):
                 # drop the learning rate and reset patience and loss
                 if self.patience_count >= self.patience:
                     self.patience_count = 0
-                    self.loss_values = []
+                    self.reset_loss_values()
                     return self.lr * self.gamma
 
             return self.lr
+
+    def get_loss_values(self):
+        # loss values in the window ordered from oldest to newest
+        if self.n_values < self.plateau_size:
+            return self.loss_values[:self.n_values].tolist()
+        return np.roll(self.loss_values, -self.head).tolist()
+
+    def state_dict(self):
+        state = super().state_dict()
+        state["patience_count"] = self.patience_count
+        state["loss_values"] = self.get_loss_values()
+        return state
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        self.patience_count = state_dict["patience_count"]
+
+        self.reset_loss_values()
+        for loss_value in state_dict["loss_values"][-self.plateau_size:]:
+            self.add_loss_value(loss_value)
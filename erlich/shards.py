@@ -0,0 +1,231 @@
+"""
+Dataset format made of fixed-dtype tensor shards.
+
+A sharded dataset is a folder containing `index.json` and, for each shard and field, a `.npy` file with the field
+of all the samples of the shard stacked along the first dimension. Shards are memory mapped and samples are
+exposed as tensors that share memory with the mapping, so no decoding or copy is done when reading.
+
+Convert any Dataset with:
+    python -m erlich.shards my_module:make_dataset output_folder --shard-size 4096 --workers 8
+"""
+import argparse
+import importlib
+import json
+import math
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, Sampler
+
+INDEX_FILE = "index.json"
+
+
+def to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def as_fields(sample):
+    if isinstance(sample, (tuple, list)):
+        return [to_numpy(x) for x in sample]
+    return [to_numpy(sample)]
+
+
+def shard_file(shard_name, field):
+    return f"{shard_name}.{field}.npy"
+
+
+class ShardedDataset(Dataset):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+
+        self.fields = self.index["fields"]
+        self.shards = self.index["shards"]
+        self.shard_sizes = [shard["size"] for shard in self.shards]
+        self.offsets = np.cumsum([0] + self.shard_sizes)
+
+        # mappings are opened lazily so that they are not pickled when the dataset is sent to DataLoader workers
+        self.mappings = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["mappings"] = None
+        return state
+
+    def open(self):
+        # copy-on-write mapping: arrays are writable (as torch expects) but the files are never modified
+        self.mappings = [[np.load(os.path.join(self.path, shard_file(shard["name"], i)), mmap_mode="c")
+                          for i in range(len(self.fields))] for shard in self.shards]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(f"Index {index} out of range for dataset of size {len(self)}")
+
+        shard = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return shard, index - int(self.offsets[shard])
+
+    def __getitem__(self, index):
+        if self.mappings is None:
+            self.open()
+
+        shard, local_index = self.locate(index)
+        return tuple(torch.from_numpy(field[local_index, ...]) for field in self.mappings[shard])
+
+    def __getitems__(self, indices):
+        return [self[i] for i in indices]
+
+
+class ShardedSampler(Sampler):
+    """
+    Sampler for ShardedDataset that shuffles the shard order and the samples inside each shard, then assigns a
+    contiguous range of this order to each rank, so that every rank reads from few files at a time.
+    Every rank gets the same number of samples (padding by repetition, or truncating when `drop_last`).
+    """
+
+    def __init__(self, dataset, shuffle=True, seed=0, drop_last=False, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if len(dataset) == 0:
+            raise Exception("Cannot sample from an empty sharded dataset")
+
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        if drop_last:
+            self.num_samples = len(dataset) // num_replicas
+        else:
+            self.num_samples = math.ceil(len(dataset) / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        n_shards = len(self.dataset.shard_sizes)
+        if self.shuffle:
+            shard_order = torch.randperm(n_shards, generator=generator).tolist()
+        else:
+            shard_order = list(range(n_shards))
+
+        indices = []
+        for shard in shard_order:
+            offset, size = int(self.dataset.offsets[shard]), self.dataset.shard_sizes[shard]
+            if self.shuffle:
+                indices.append(torch.randperm(size, generator=generator) + offset)
+            else:
+                indices.append(torch.arange(offset, offset + size))
+        indices = torch.cat(indices)
+
+        # pad by repetition (or truncate) so that every rank gets the same number of samples
+        total_size = self.num_samples * self.num_replicas
+        if total_size > len(indices):
+            indices = indices.repeat(math.ceil(total_size / len(indices)))
+        indices = indices[:total_size]
+
+        # contiguous chunk of the shard ordered indices, a rank only touches few shards
+        indices = indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+_writer_dataset = None
+
+
+def _init_writer(dataset):
+    global _writer_dataset
+    _writer_dataset = dataset
+
+
+def _write_shard(args):
+    path, shard_name, start, end, fields = args
+    outputs = [np.lib.format.open_memmap(os.path.join(path, shard_file(shard_name, i)), mode="w+",
+                                         dtype=np.dtype(field["dtype"]), shape=(end - start, *field["shape"]))
+               for i, field in enumerate(fields)]
+
+    for i in range(start, end):
+        for output, value in zip(outputs, as_fields(_writer_dataset[i])):
+            output[i - start] = value
+
+    for output in outputs:
+        output.flush()
+
+    return shard_name, end - start
+
+
+def write_shards(dataset, path, shard_size=4096, num_workers=0):
+    """
+    Convert a map-style dataset to a ShardedDataset in `path`, writing shards in parallel with `num_workers` processes
+    """
+    if len(dataset) == 0:
+        raise Exception("Cannot write shards of an empty dataset")
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    # dtype and shape of every field are taken from the first sample
+    fields = [{"dtype": str(x.dtype), "shape": list(x.shape)} for x in as_fields(dataset[0])]
+
+    n = len(dataset)
+    jobs = [(path, f"shard_{i:05d}", start, min(start + shard_size, n), fields)
+            for i, start in enumerate(range(0, n, shard_size))]
+
+    if num_workers > 0:
+        with multiprocessing.Pool(num_workers, initializer=_init_writer, initargs=(dataset,)) as pool:
+            shards = pool.map(_write_shard, jobs, chunksize=1)
+    else:
+        _init_writer(dataset)
+        shards = [_write_shard(job) for job in jobs]
+
+    with open(os.path.join(path, INDEX_FILE), "w") as f:
+        json.dump({
+            "fields": fields,
+            "shards": [{"name": name, "size": size} for name, size in shards],
+        }, f, indent=2)
+
+    print(f"Wrote {n} samples in {len(shards)} shards to '{path}'")
+
+
+def load_object(spec):
+    module_name, attr = spec.split(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a Dataset to erlich's sharded format")
+    parser.add_argument("dataset", help="'module:attribute' of a Dataset or of a function that returns one")
+    parser.add_argument("output", help="output folder")
+    parser.add_argument("--shard-size", type=int, default=4096, help="samples per shard")
+    parser.add_argument("--workers", type=int, default=0, help="number of writer processes")
+    args = parser.parse_args()
+
+    dataset = load_object(args.dataset)
+    if not isinstance(dataset, Dataset) and callable(dataset):
+        dataset = dataset()
+
+    write_shards(dataset, args.output, args.shard_size, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Gradient and weight statistics of the model parts, to diagnose diverging trainings.
+
+At the steps where the logger writes a line, the trainer measures for each trainable part the norm of its gradients,
+the norm of its weights, the ratio between the norm of the update of the optimizers and the norm of the weights and the
+number of non-finite gradient values. Norms use multi-tensor operations (one kernel for all the tensors of a part)
+and all the values stay on the device until they are transferred to the host at once, so the other steps pay nothing
+and logged steps synchronize only once.
+
+The update is the difference between the weights after and before the step, which needs a copy of the weights. To
+bound that memory the trainable parts take turns: at each measured step only the weights of one part are copied, the
+update ratio of the other parts is the one of their last measured step. The extra memory is the size of the largest
+trainable part instead of the whole model.
+"""
+import torch
+import torch.distributed as dist
+
+STATISTICS = ["grad_norm", "weight_norm", "update_ratio", "nonfinite"]
+
+
+def get_statistics(cfg):
+    """
+    Statistics enabled by `parameter_statistics` (true for all of them, or a list of names)
+    """
+    statistics = cfg.get("parameter_statistics", False)
+    if not statistics:
+        return []
+    if isinstance(statistics, bool):
+        return list(STATISTICS)
+
+    statistics = list(statistics)
+    for name in statistics:
+        if name not in STATISTICS:
+            raise Exception(f"Unknown parameter statistic '{name}', choose among {STATISTICS}")
+    return statistics
+
+
+def fused_norm(tensors, device):
+    """
+    L2 norm of all the values of `tensors`, in float32
+    """
+    if not tensors:
+        return torch.zeros((), device=device)
+    return torch.linalg.vector_norm(torch.stack(torch._foreach_norm(tensors, 2, dtype=torch.float32)))
+
+
+class ParameterStatistics:
+    def __init__(self, names, statistics, device):
+        """
+        `names` are the trainable parts of the whole model in a fixed order, with pipeline parallelism each rank
+        measures the parts of its stage and the values of all the stages are summed in a single all-reduce
+        """
+        self.names = names
+        self.statistics = statistics
+        self.device = device
+
+        self.values = None
+        self.weights = None
+        # part whose update is measured at the next step, and last update ratio of each part
+        self.update_index = 0
+        self.update_ratios = dict()
+
+    @staticmethod
+    def parameters(part):
+        return [p for p in part.parameters() if p.requires_grad]
+
+    def before_step(self, model_parts):
+        """
+        Called after the backward pass (with unscaled gradients) and before the optimizers step
+        """
+        self.values = dict()
+        self.weights = dict()
+        for name in self.names:
+            if name not in model_parts:
+                continue
+
+            params = self.parameters(model_parts[name])
+            grads = [p.grad for p in params if p.grad is not None]
+            values = dict()
+            if "grad_norm" in self.statistics:
+                values["grad_norm"] = fused_norm(grads, self.device)
+            if "weight_norm" in self.statistics or "update_ratio" in self.statistics:
+                values["weight_norm"] = fused_norm([p.detach() for p in params], self.device)
+            if "nonfinite" in self.statistics:
+                values["nonfinite"] = sum((torch.count_nonzero(~torch.isfinite(g)) for g in grads),
+                                          torch.zeros((), dtype=torch.int64, device=self.device))
+            self.values[name] = values
+
+        if "update_ratio" in self.statistics and self.names:
+            name = self.names[self.update_index % len(self.names)]
+            self.update_index += 1
+            # with pipeline parallelism the part may belong to another stage
+            if name in model_parts:
+                self.weights[name] = [p.detach().clone() for p in self.parameters(model_parts[name])]
+
+    def after_step(self, model_parts):
+        for name, weights in self.weights.items():
+            params = [p.detach() for p in self.parameters(model_parts[name])]
+            # the difference is computed in place, the copy becomes the update
+            torch._foreach_sub_(weights, params)
+            update = fused_norm(weights, self.device)
+            self.update_ratios[name] = update / self.values[name]["weight_norm"].clamp_min(1e-12)
+        self.weights = None
+
+        if "update_ratio" in self.statistics:
+            for name, values in self.values.items():
+                if name in self.update_ratios:
+                    values["update_ratio"] = self.update_ratios[name]
+
+    def collect(self, distributed=False):
+        """
+        Values of the last measured step as {"<statistic>/<part>": value}, `distributed` sums the values of all the
+        ranks (every rank must call it)
+        """
+        keys = [(name, s) for name in self.names for s in self.statistics]
+        zero = torch.zeros((), device=self.device)
+        measured = self.values if self.values is not None else dict()
+        buffer = torch.stack([measured.get(name, dict()).get(s, zero).double() for name, s in keys])
+        if distributed:
+            dist.all_reduce(buffer)
+        values = buffer.tolist()
+        self.values = None
+
+        return {f"{s}/{name}": int(v) if s == "nonfinite" else v for (name, s), v in zip(keys, values)}
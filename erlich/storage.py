@@ -0,0 +1,434 @@
+"""
+Storage backends for checkpoints.
+
+A backend stores objects under "/" separated keys. `LocalBackend` uses a folder of the local filesystem,
+`ObjectStoreBackend` an S3 compatible object store: a boto3 S3 client, or `LocalObjectStore` which emulates one on a
+local folder. Objects are written in chunks that are uploaded in parallel while the rest is being serialized.
+Objects of an object store are read with parallel ranged requests into a local read-through cache, so repeated loads
+(and memory mapping) use local files.
+"""
+import datetime
+import hashlib
+import io
+import os
+import posixpath
+import tempfile
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+CHUNK_SIZE = 16 * 2 ** 20
+MAX_WORKERS = 8
+
+
+def is_missing(e):
+    """
+    Whether `e` reports a missing object (boto3 raises a ClientError with a 404 code)
+    """
+    if isinstance(e, FileNotFoundError):
+        return True
+    code = getattr(e, "response", dict()).get("Error", dict()).get("Code", None)
+    return code in ["404", "NoSuchKey", "NotFound"]
+
+
+class ChunkedWriter(io.RawIOBase):
+    """
+    File-like object writing an object of a backend. Each full chunk is uploaded by a thread pool while the next one
+    is being filled, with at most `max_workers` chunks in flight. Objects smaller than a chunk are written at once.
+    The object is only visible once the writer is closed, it is discarded if the `with` block raises.
+    """
+
+    def __init__(self, backend, key):
+        super().__init__()
+        self.backend = backend
+        self.key = key
+        self.buffer = bytearray()
+        self.offset = 0
+        self.upload = None
+        self.executor = None
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        chunk_size = self.backend.chunk_size
+        while len(self.buffer) >= chunk_size:
+            self.submit(bytes(self.buffer[:chunk_size]))
+            del self.buffer[:chunk_size]
+        return len(data)
+
+    def submit(self, chunk):
+        if self.upload is None:
+            self.upload = self.backend.start_upload(self.key)
+            self.executor = ThreadPoolExecutor(self.backend.max_workers, thread_name_prefix="erlich-upload")
+
+        pending = [f for f in self.parts if not f.done()]
+        if len(pending) >= self.backend.max_workers:
+            wait(pending, return_when=FIRST_COMPLETED)
+
+        self.parts.append(self.executor.submit(self.backend.upload_part, self.upload, len(self.parts), self.offset,
+                                               chunk))
+        self.offset += len(chunk)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload is None:
+                self.backend.write_bytes(self.key, bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.submit(bytes(self.buffer))
+                self.backend.finish_upload(self.upload, [f.result() for f in self.parts])
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self.release()
+
+    def abort(self):
+        if self.upload is not None:
+            wait(self.parts)
+            self.backend.abort_upload(self.upload)
+            self.upload = None
+
+    def release(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # a partially serialized object must not become visible
+        self.abort()
+        self.release()
+
+
+class LocalBackend:
+    """
+    Objects are files in `root`, with an empty root keys are paths
+    """
+
+    def __init__(self, root="", chunk_size=CHUNK_SIZE, max_workers=MAX_WORKERS):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+    def path(self, key):
+        return os.path.join(self.root, key) if self.root else key
+
+    def local_path(self, key):
+        # files are read (or memory mapped) in place
+        return self.path(key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def touch(self, key):
+        """
+        Refresh the modification time of an object, returns False if it doesn't exist
+        """
+        try:
+            os.utime(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def read_bytes(self, key):
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def write_bytes(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def open_write(self, key):
+        return ChunkedWriter(self, key)
+
+    def start_upload(self, key):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        return path, tmp_path, os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def upload_part(self, upload, index, offset, data):
+        _, _, fd = upload
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view, offset = view[written:], offset + written
+
+    def finish_upload(self, upload, parts):
+        path, tmp_path, fd = upload
+        os.close(fd)
+        os.replace(tmp_path, path)
+
+    def abort_upload(self, upload):
+        _, tmp_path, fd = upload
+        os.close(fd)
+        os.remove(tmp_path)
+
+    def delete(self, key):
+        os.remove(self.path(key))
+
+    def list(self, prefix=""):
+        """
+        (key, size, modification time) of the objects whose key starts with `prefix`. Symbolic links (e.g. the
+        `latest` links of old model folders) and partially written files are skipped.
+        """
+        path = self.path(prefix)
+        folder = path if prefix.endswith("/") or not prefix else os.path.dirname(path)
+        res = []
+        for dirpath, _, filenames in os.walk(folder or "."):
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                key = os.path.relpath(file_path, self.root).replace(os.sep, "/") if self.root else file_path
+                if not key.startswith(prefix) or filename.endswith(".tmp") or os.path.islink(file_path):
+                    continue
+                stat = os.stat(file_path)
+                res.append((key, stat.st_size, stat.st_mtime))
+        return sorted(res)
+
+
+class ObjectStoreBackend:
+    """
+    Objects in `bucket` of an S3 compatible `client` (e.g. `boto3.client("s3")` or a `LocalObjectStore`), under
+    `prefix`. Reads go through a local cache in `cache_dir`, validated with the ETag of the object.
+    """
+
+    def __init__(self, client, bucket, prefix="", cache_dir=None, chunk_size=CHUNK_SIZE, max_workers=MAX_WORKERS):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(tempfile.gettempdir(), "erlich-cache")
+        # multipart uploads need parts of at least 5 MiB (except the last one)
+        self.chunk_size = max(chunk_size, 5 * 2 ** 20)
+        self.max_workers = max_workers
+
+    def object_key(self, key):
+        return posixpath.join(self.prefix, key) if self.prefix else key
+
+    def head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except Exception as e:
+            if is_missing(e):
+                return None
+            raise
+
+    def exists(self, key):
+        return self.head(key) is not None
+
+    def touch(self, key):
+        # objects are immutable, copying one onto itself refreshes its modification time
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=self.object_key(key), MetadataDirective="REPLACE",
+                                    CopySource={"Bucket": self.bucket, "Key": self.object_key(key)})
+            return True
+        except Exception as e:
+            if is_missing(e):
+                return False
+            raise
+
+    def read_bytes(self, key, byte_range=None):
+        kwargs = {"Range": f"bytes={byte_range[0]}-{byte_range[1] - 1}"} if byte_range is not None else dict()
+        return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key), **kwargs)["Body"].read()
+
+    def write_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=data)
+
+    def open_write(self, key):
+        return ChunkedWriter(self, key)
+
+    def start_upload(self, key):
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.object_key(key))
+        return self.object_key(key), response["UploadId"]
+
+    def upload_part(self, upload, index, offset, data):
+        key, upload_id = upload
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=index + 1,
+                                           Body=data)
+        return {"PartNumber": index + 1, "ETag": response["ETag"]}
+
+    def finish_upload(self, upload, parts):
+        key, upload_id = upload
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                              MultipartUpload={"Parts": parts})
+
+    def abort_upload(self, upload):
+        key, upload_id = upload
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def list(self, prefix=""):
+        res = []
+        kwargs = {"Bucket": self.bucket, "Prefix": self.object_key(prefix)}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            for obj in response.get("Contents", []):
+                key = obj["Key"][len(self.prefix) + 1:] if self.prefix else obj["Key"]
+                res.append((key, obj["Size"], obj["LastModified"].timestamp()))
+            if not response.get("IsTruncated", False):
+                return res
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def local_path(self, key):
+        """
+        Path of a local copy of the object, downloaded with parallel ranged reads unless already cached
+        """
+        head = self.head(key)
+        if head is None:
+            raise FileNotFoundError(f"Object '{self.object_key(key)}' not found in bucket '{self.bucket}'")
+
+        path = os.path.join(self.cache_dir, self.bucket, *self.object_key(key).split("/"))
+        etag_path = f"{path}.etag"
+        if os.path.exists(path) and os.path.exists(etag_path):
+            with open(etag_path) as f:
+                if f.read() == head["ETag"]:
+                    return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = head["ContentLength"]
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            def download(start):
+                data = self.read_bytes(key, (start, min(start + self.chunk_size, size)))
+                os.pwrite(fd, data, start)
+
+            with ThreadPoolExecutor(self.max_workers, thread_name_prefix="erlich-download") as executor:
+                for future in [executor.submit(download, start) for start in range(0, size, self.chunk_size)]:
+                    future.result()
+        finally:
+            os.close(fd)
+
+        os.replace(tmp_path, path)
+        with open(etag_path, "w") as f:
+            f.write(head["ETag"])
+        return path
+
+
+class LocalObjectStore:
+    """
+    Minimal S3 compatible client storing the objects in a local folder, with the subset of the boto3 S3 API used by
+    `ObjectStoreBackend` (stand-in for tests and single machine setups)
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def upload_path(self, bucket, upload_id, part_number=None):
+        path = os.path.join(self.root, ".uploads", bucket, upload_id)
+        return path if part_number is None else os.path.join(path, f"{part_number:05d}")
+
+    @staticmethod
+    def etag(data):
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with open(f"{tmp_path}.etag", "w") as f:
+            f.write(self.etag(data))
+        # the data is replaced before its ETag, a reader never caches old data under the new ETag
+        os.replace(tmp_path, path)
+        os.replace(f"{tmp_path}.etag", f"{path}.etag")
+
+    def put_object(self, Bucket, Key, Body):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.write(self.path(Bucket, Key), data)
+        return {"ETag": self.etag(data)}
+
+    def head_object(self, Bucket, Key):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No such key '{Key}'")
+        with open(f"{path}.etag") as f:
+            etag = f.read()
+        return {"ContentLength": os.path.getsize(path), "ETag": etag,
+                "LastModified": datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No such key '{Key}'")
+        with open(path, "rb") as f:
+            if Range is None:
+                data = f.read()
+            else:
+                start, end = [int(x) for x in Range[len("bytes="):].split("-")]
+                f.seek(start)
+                data = f.read(end - start + 1)
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective="COPY"):
+        source = self.path(CopySource["Bucket"], CopySource["Key"])
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"No such key '{CopySource['Key']}'")
+        with open(source, "rb") as f:
+            data = f.read()
+        self.write(self.path(Bucket, Key), data)
+        return {"CopyObjectResult": {"ETag": self.etag(data)}}
+
+    def delete_object(self, Bucket, Key):
+        path = self.path(Bucket, Key)
+        for p in [path, f"{path}.etag"]:
+            if os.path.exists(p):
+                os.remove(p)
+        return dict()
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        bucket_path = os.path.join(self.root, Bucket)
+        contents = []
+        for dirpath, _, filenames in os.walk(bucket_path):
+            for filename in filenames:
+                if filename.endswith(".etag") or filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, bucket_path).replace(os.sep, "/")
+                if key.startswith(Prefix):
+                    contents.append({"Key": key, "Size": os.path.getsize(path), "LastModified":
+                                     datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)})
+        return {"Contents": sorted(contents, key=lambda x: x["Key"]), "IsTruncated": False}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self.upload_path(Bucket, upload_id))
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with open(self.upload_path(Bucket, UploadId, PartNumber), "wb") as f:
+            f.write(data)
+        return {"ETag": self.etag(data)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = sorted(MultipartUpload["Parts"], key=lambda x: x["PartNumber"])
+        data = b"".join(open(self.upload_path(Bucket, UploadId, p["PartNumber"]), "rb").read() for p in parts)
+        self.write(self.path(Bucket, Key), data)
+        self.abort_multipart_upload(Bucket, Key, UploadId)
+        return {"ETag": self.etag(data)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        path = self.upload_path(Bucket, UploadId)
+        for part in os.listdir(path) if os.path.exists(path) else []:
+            os.remove(os.path.join(path, part))
+        if os.path.exists(path):
+            os.rmdir(path)
+        return dict()
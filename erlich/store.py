@@ -0,0 +1,119 @@
+"""
+Content addressed storage of checkpoints.
+
+Tensors larger than `BLOB_MIN_BYTES` are saved as blobs named after the hash of their content in a store shared by all
+the models of a model folder, a checkpoint only contains a manifest referencing them. Tensors that did not change since
+a previous save (e.g. frozen parts or parts loaded from other models) are written only once.
+Blobs are never removed when saving, `BlobStore.gc` deletes the ones no longer referenced by any checkpoint.
+"""
+import hashlib
+import posixpath
+import time
+
+import torch
+
+from .storage import LocalBackend
+
+MANIFEST_FORMAT = "erlich-manifest-1"
+BLOB_KEY = "__blob__"
+BLOB_MIN_BYTES = 4096
+
+
+def tensor_hash(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    h = hashlib.sha256(f"{tensor.dtype}{tuple(tensor.shape)}".encode())
+    h.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+    return h.hexdigest()
+
+
+class BlobStore:
+    def __init__(self, path, backend=None):
+        # key prefix of the blobs in the storage backend, a folder with the default local backend
+        self.path = path
+        self.backend = backend if backend is not None else LocalBackend()
+
+        # bytes written by the last `to_manifest`
+        self.written_bytes = 0
+
+    def blob_path(self, blob_hash):
+        return posixpath.join(self.path, blob_hash[:2], blob_hash + ".pt")
+
+    def put(self, tensor):
+        blob_hash = tensor_hash(tensor)
+        path = self.blob_path(blob_hash)
+        # an existing blob is refreshed, so that `gc` doesn't delete it before the manifest referencing it is saved
+        if not self.backend.touch(path):
+            tensor = tensor.detach().cpu()
+            # saving a view would save its whole storage
+            if tensor.untyped_storage().nbytes() != tensor.nbytes:
+                tensor = tensor.clone()
+
+            with self.backend.open_write(path) as f:
+                torch.save(tensor, f)
+            self.written_bytes += tensor.nbytes
+
+        return blob_hash
+
+    def get(self, blob_hash, map_location=None, mmap=False):
+        return torch.load(self.backend.local_path(self.blob_path(blob_hash)), map_location=map_location, mmap=mmap)
+
+    def to_manifest(self, obj):
+        """
+        Store the large tensors contained in `obj` (nested dicts, lists and tuples) and replace them with references
+        """
+        if isinstance(obj, torch.Tensor) and obj.nbytes >= BLOB_MIN_BYTES:
+            return {BLOB_KEY: self.put(obj)}
+        if isinstance(obj, dict):
+            return {k: self.to_manifest(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.to_manifest(x) for x in obj)
+        return obj
+
+    def from_manifest(self, obj, map_location=None, mmap=False):
+        if isinstance(obj, dict):
+            if BLOB_KEY in obj:
+                return self.get(obj[BLOB_KEY], map_location, mmap)
+            return {k: self.from_manifest(v, map_location, mmap) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.from_manifest(x, map_location, mmap) for x in obj)
+        return obj
+
+    @staticmethod
+    def references(obj, refs=None):
+        refs = refs if refs is not None else set()
+        if isinstance(obj, dict):
+            if BLOB_KEY in obj:
+                refs.add(obj[BLOB_KEY])
+            else:
+                for v in obj.values():
+                    BlobStore.references(v, refs)
+        elif isinstance(obj, (list, tuple)):
+            for x in obj:
+                BlobStore.references(x, refs)
+        return refs
+
+    def gc(self, checkpoint_paths, grace_period=3600):
+        """
+        Delete blobs not referenced by any of the checkpoints. Blobs written or reused in the last `grace_period`
+        seconds are kept, they may belong to a checkpoint that is being saved.
+        Returns the number of deleted blobs and their size in bytes.
+        """
+        refs = set()
+        for path in checkpoint_paths:
+            # only the manifest is needed, the tensors of checkpoints saved without the store are mapped and not read
+            checkpoint = torch.load(self.backend.local_path(path), map_location="cpu", mmap=True, weights_only=True)
+            if isinstance(checkpoint, dict) and checkpoint.get("format") == MANIFEST_FORMAT:
+                self.references(checkpoint, refs)
+
+        deleted, deleted_bytes = 0, 0
+        now = time.time()
+        for path, size, mtime in self.backend.list(self.path.rstrip("/") + "/"):
+            if not path.endswith(".pt"):
+                continue
+            blob_hash = posixpath.basename(path)[:-len(".pt")]
+            if blob_hash not in refs and now - mtime > grace_period:
+                deleted_bytes += size
+                self.backend.delete(path)
+                deleted += 1
+
+        return deleted, deleted_bytes
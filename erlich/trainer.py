@@ -1,17 +1,44 @@
+import contextlib
+import copy
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
-from torch.cuda import amp
+import torch.distributed as dist
+from omegaconf import OmegaConf
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
 from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 import abc
 
+from .affinity import AFFINITY_DEFAULTS, available_cores, format_layout, parse_cores, pin_current_thread, \
+    pin_process, plan_cpu_layout, set_worker_affinity
+from .cache import FeatureCache
+from .data import dataset_size, set_dataloader_epoch, set_num_workers, skip_batches, unshard_dataloader
+from .ensemble import EnsembleMeter, replica_name, split_replica_values
+from .logging import MetricsReducer
+from .pipeline import Pipeline, get_pipeline_stages
+from .preemption import PreemptionHandler
 from .schedulers import WarmupScheduler, WarmupPlateauScheduler, WarmupStepScheduler
+from .statistics import ParameterStatistics, get_statistics
+
+
+def tensor_to_device(x, device, memory_format=None):
+    # memory format only applies to 4-D (NCHW) tensors
+    if memory_format is not None and x.dim() == 4:
+        return x.to(device, memory_format=memory_format)
+    return x.to(device)
 
 
-def move_to_device(batch, device):
+def move_to_device(batch, device, memory_format=None):
     if isinstance(batch, tuple) or isinstance(batch, list):
-        return [x.to(device) for x in batch]
+        return [tensor_to_device(x, device, memory_format) for x in batch]
     else:
-        return batch.to(device)
+        return tensor_to_device(batch, device, memory_format)
 
 
 def get_batch_size(batch):
@@ -21,6 +48,136 @@ def get_batch_size(batch):
         return batch.size(0)
 
 
+def get_rng_states():
+    np_state = np.random.get_state()
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        # store numpy state as plain python objects so that it can be loaded without unpickling arrays
+        "numpy": (np_state[0], np_state[1].tolist(), *np_state[2:]),
+        "python": random.getstate(),
+    }
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states["torch"].cpu())
+    if states["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([x.cpu() for x in states["cuda"]])
+    np_state = states["numpy"]
+    np.random.set_state((np_state[0], np.asarray(np_state[1], dtype=np.uint32), *np_state[2:]))
+    python_state = states["python"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+
+
+def clone_inference_tensors(x):
+    if isinstance(x, torch.Tensor):
+        return x.clone() if x.is_inference() else x
+    if isinstance(x, (tuple, list)):
+        return type(x)(clone_inference_tensors(y) for y in x)
+    if isinstance(x, dict):
+        return {k: clone_inference_tensors(x[k]) for k in x}
+    return x
+
+
+def requires_grad(x):
+    if isinstance(x, torch.Tensor):
+        return x.requires_grad
+    if isinstance(x, (tuple, list)):
+        return any(requires_grad(y) for y in x)
+    if isinstance(x, dict):
+        return any(requires_grad(y) for y in x.values())
+    return False
+
+
+class InferenceModeHooks:
+    """
+    Forward hooks running a module under inference_mode. Outputs are cloned outside inference mode so that they can be
+    used by parts that are trained. A module whose inputs require grad (e.g. a frozen decoder or loss network after a
+    trained part) runs normally, gradients flow through it to the inputs.
+    """
+
+    def __init__(self):
+        self.contexts = []
+
+    def before(self, module, args):
+        context = torch.inference_mode() if not requires_grad(args) else contextlib.nullcontext()
+        context.__enter__()
+        self.contexts.append(context)
+
+    def after(self, module, args, output):
+        self.contexts.pop().__exit__(None, None, None)
+        if torch.is_inference_mode_enabled():
+            return output
+        return clone_inference_tensors(output)
+
+
+def freeze_part(part):
+    part.requires_grad_(False)
+    part.eval()
+    hooks = InferenceModeHooks()
+    part.register_forward_pre_hook(hooks.before)
+    part.register_forward_hook(hooks.after, always_call=True)
+
+
+def unwrap_part(part):
+    return part.module if isinstance(part, DistributedDataParallel) else part
+
+
+def redirect_part_attributes(obj, old_parts, new_parts):
+    """
+    Point the attributes of `obj` that reference one of `old_parts` (e.g. `self.encoder = self.model_parts["encoder"]`)
+    to the part with the same name in `new_parts`
+    """
+    names = {id(old_parts[k]): k for k in old_parts}
+    for attr, value in list(vars(obj).items()):
+        if id(value) in names:
+            setattr(obj, attr, new_parts[names[id(value)]])
+
+
+# DistributedDataParallel options that can be set from the `ddp` section of the configuration
+DDP_DEFAULTS = {"bucket_cap_mb": 25, "gradient_as_bucket_view": False, "static_graph": False,
+                "find_unused_parameters": False, "broadcast_buffers": True}
+# gradient compression: none, fp16, bf16 or powersgd
+DDP_HOOK_DEFAULTS = {"comm_hook": "none", "powersgd_rank": 1, "powersgd_start_iter": 10}
+
+
+def register_comm_hook(model, hook_cfg):
+    hook = hook_cfg["comm_hook"]
+    if hook == "none":
+        return
+    if hook == "fp16":
+        model.register_comm_hook(None, default_hooks.fp16_compress_hook)
+    elif hook == "bf16":
+        model.register_comm_hook(None, default_hooks.bf16_compress_hook)
+    elif hook == "powersgd":
+        state = powerSGD_hook.PowerSGDState(process_group=None,
+                                            matrix_approximation_rank=hook_cfg["powersgd_rank"],
+                                            start_powerSGD_iter=hook_cfg["powersgd_start_iter"])
+        model.register_comm_hook(state, powerSGD_hook.powerSGD_hook)
+    else:
+        raise Exception(f"Unknown DDP communication hook '{hook}'")
+
+
+# autocast dtype of each precision mode
+PRECISIONS = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def get_precision(cfg):
+    # `mixed_precision: true` is the legacy way of asking for fp16
+    precision = cfg.get("precision", "fp16" if cfg.get("mixed_precision", False) else "fp32")
+    if precision not in PRECISIONS:
+        raise Exception(f"Unknown precision '{precision}', choose one of {list(PRECISIONS)}")
+    return precision
+
+
+def precision_autocast(precision, device, enabled=True):
+    """
+    Autocast context for a precision mode ("fp32", "fp16" or "bf16") on the type of `device`
+    """
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=enabled and dtype is not None)
+
+
 class AvgEstimator:
     def __init__(self):
         self.avg = 0.0
@@ -49,22 +206,135 @@ class BaseTrainer(abc.ABC):
         self.model_parts = model_parts
         self.saver = saver
         self.logger = logger
+        # folder of the model, known by every rank (only rank 0 has a saver), set by the manager
+        self.model_path = None
 
         self.dataloader = None
         self.validation_dataloader = None
         self.model = None
 
+        self.seed = cfg.get("seed", 42)
+
+        # with pipeline parallelism each rank holds only the parts of its stage (see `Pipeline`)
+        self.pipeline = None
+        self.pipeline_stages = get_pipeline_stages(cfg, world_size) if cfg.get("pipeline", False) else None
+
+        # frozen parts run in eval mode without tracking gradients, their outputs can be cached on disk
+        self.frozen_parts = [k for k in cfg.parts if cfg.parts[k].get("frozen", False) and k in model_parts]
+        for k in self.frozen_parts:
+            freeze_part(self.model_parts[k])
+        self.feature_caches = dict()
+
+        # inputs are converted to channels_last when some part uses it
+        self.memory_format = torch.channels_last \
+            if any(cfg.parts[k].get("memory_format", None) == "channels_last" for k in cfg.parts) else None
+
+        self.precision = get_precision(cfg)
+        # bf16 has the same range of fp32, only fp16 needs loss scaling
+        self.scaler = torch.amp.GradScaler(torch.device(device).type, enabled=self.precision == "fp16")
+
+        # position from which training starts, changed when resuming from a checkpoint
+        self.start_epoch = 0
+        self.start_batch = 0
+
+        # save a checkpoint (without validating) every `checkpoint_every` minutes
+        self.checkpoint_every = cfg.get("checkpoint_every", -1)
+        # when the ranks must agree on it, the clock is checked every `checkpoint_check_every` steps
+        self.checkpoint_check_every = max(1, cfg.get("checkpoint_check_every", 10))
+        self.checkpoint_polls = 0
+        self.last_checkpoint_time = time.time()
+        # RNG states of all the ranks gathered on rank 0 for the next checkpoint (see `prepare_checkpoint`)
+        self.rank_rng_states = None
+        # on SIGTERM/SIGUSR1 save a checkpoint at the next check (every step on a single process) and stop training
+        preemption_cfg = cfg.get("checkpoint_on_signal", False)
+        self.preemption = None
+        if preemption_cfg:
+            preemption_cfg = preemption_cfg if not isinstance(preemption_cfg, bool) else dict()
+            self.preemption = PreemptionHandler(**self.standardize_kwargs(preemption_cfg, check_every=10))
+        self.interrupted = False
+
+        # cores of the main process, data workers and background threads of this rank (see `set_cpu_affinity`)
+        self.cpu_layout = None
+
+        # validate on a snapshot of the weights in a background thread while training continues
+        self.async_validation = cfg.get("async_validation", False)
+        self.validation_parts = None
+        self.validation_future = None
+        self.validation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="erlich-validation",
+                                                      initializer=self.pin_background_thread) \
+            if self.async_validation else None
+
+        # number of replicas of the model trained together (see `EnsemblePart`)
+        self.ensemble = cfg.get("ensemble", 1)
+
+        if self.pipeline_stages is not None:
+            for option, enabled in [("ensemble", self.ensemble > 1), ("async_validation", self.async_validation),
+                                    ("precision: fp16", self.precision == "fp16")]:
+                if enabled:
+                    raise Exception(f"Pipeline parallelism doesn't support {option}")
+        # replica whose loss drives each scheduler
+        self.scheduler_replicas = dict()
+
+        self.metrics_reducer = None
+        self.forward_time = 0.0
+
+        # gradient and weight statistics of the trainable parts, measured only at the logged steps
+        statistics = get_statistics(cfg)
+        self.parameter_statistics = ParameterStatistics(
+            [k for k in cfg.parts if not cfg.parts[k].get("frozen", False)], statistics, device) if statistics else None
+        self.measure_statistics = False
+
         self.train_metrics = self.get_train_metrics()
+        if self.ensemble > 1:
+            self.train_metrics = {k: EnsembleMeter(self.train_metrics[k], self.ensemble) for k in self.train_metrics}
 
         # Add train metrics to logger
         if self.logger is not None:
             for metric in self.train_metrics.values():
-                self.logger.add_meter(metric)
+                for meter in getattr(metric, "meters", [metric]):
+                    self.logger.add_meter(meter)
 
     def create_dataloaders(self):
         self.dataloader = self.get_dataloader(self.batch_size)
         self.validation_dataloader = self.get_validation_dataloader(self.validation_batch_size)
 
+        # number of workers chosen by autotune (or set explicitly in the configuration)
+        if self.cfg.get("num_workers", None) is not None:
+            self.dataloader = set_num_workers(self.dataloader, self.cfg.num_workers)
+
+        # pipeline stages work on the same batches, the first one reads the inputs and the last one the targets
+        if self.pipeline_stages is not None and self.world_size > 1:
+            self.dataloader = unshard_dataloader(self.dataloader)
+            self.validation_dataloader = unshard_dataloader(self.validation_dataloader)
+
+    def set_cpu_affinity(self):
+        """
+        Give this rank its share of the CPU cores, split between the main process, the data loader workers and the
+        background threads (options from the `cpu_affinity` section of the configuration)
+        """
+        affinity_cfg = self.cfg.cpu_affinity if not isinstance(self.cfg.cpu_affinity, bool) else dict()
+        kwargs = self.standardize_kwargs(affinity_cfg, **AFFINITY_DEFAULTS)
+        cores = parse_cores(kwargs["cores"]) if kwargs["cores"] is not None else available_cores()
+
+        num_workers = max(getattr(x, "num_workers", 0) for x in [self.dataloader, self.validation_dataloader]
+                          if x is not None)
+        self.cpu_layout = plan_cpu_layout(cores, self.rank, self.world_size, num_workers,
+                                          kwargs["background_cores"], kwargs["worker_cores"])
+
+        num_threads = kwargs["num_threads"] or len(self.cpu_layout["main"])
+        pin_process(self.cpu_layout["main"])
+        torch.set_num_threads(num_threads)
+
+        self.dataloader = set_worker_affinity(self.dataloader, self.cpu_layout["workers"], kwargs["worker_threads"])
+        self.validation_dataloader = set_worker_affinity(self.validation_dataloader, self.cpu_layout["workers"],
+                                                         kwargs["worker_threads"])
+
+        print(f"CPU layout of rank {self.rank}: {format_layout(self.cpu_layout, num_threads)}")
+
+    def pin_background_thread(self):
+        if self.cpu_layout is not None:
+            pin_current_thread(self.cpu_layout["background"])
+
     @staticmethod
     def standardize_kwargs(cfg, **kwargs):
         return {k: cfg[k] if k in cfg else kwargs[k] for k in kwargs}
@@ -110,19 +380,36 @@ class BaseTrainer(abc.ABC):
         return self.default_get_optimizer(name, optim_cfg, parameters, cfg)
 
     def instantiate_optimizers(self, cfg):
+        # in an ensemble each replica has its own optimizers and schedulers, named "<name>@<replica>"
+        for replica in range(self.ensemble):
+            self.instantiate_replica_optimizers(cfg, replica)
+
+    def replica_key(self, name, replica):
+        return replica_name(name, replica) if self.ensemble > 1 else name
+
+    def replica_parameters(self, part_name, replica):
+        if self.ensemble > 1:
+            return unwrap_part(self.model_parts[part_name]).replicas[replica].parameters()
+        return self.model_parts[part_name].parameters()
+
+    def instantiate_replica_optimizers(self, cfg, replica):
         require_global_optimizer = []
         for part_name in cfg.parts:
+            # with pipeline parallelism other ranks optimize the parts of the other stages
+            if part_name not in self.model_parts:
+                continue
             part = cfg.parts[part_name]
             # if part requires an optimizer
             if "frozen" not in part or part["frozen"] is False:
+                key = self.replica_key(part_name, replica)
                 # if part has specific optimizer
                 if "optimizer" in part:
-                    self.optimizers[part_name] = self.get_optimizer(part.optimizer.name, part.optimizer,
-                                                                    self.model_parts[part_name].parameters(), cfg)
+                    self.optimizers[key] = self.get_optimizer(part.optimizer.name, part.optimizer,
+                                                              self.replica_parameters(part_name, replica), cfg)
                     if "scheduler" in part.optimizer:
                         sched = part.optimizer.scheduler
-                        self.schedulers[part_name] = self.get_scheduler(sched.name, self.optimizers[part_name], sched,
-                                                                        cfg)
+                        self.schedulers[key] = self.get_scheduler(sched.name, self.optimizers[key], sched, cfg)
+                        self.scheduler_replicas[key] = replica
                 else:
                     require_global_optimizer.append(part_name)
 
@@ -130,18 +417,109 @@ class BaseTrainer(abc.ABC):
         if require_global_optimizer:
             global_opt_parameters = []
             for x in require_global_optimizer:
-                global_opt_parameters += list(self.model_parts[x].parameters())
+                global_opt_parameters += list(self.replica_parameters(x, replica))
 
-            self.optimizers["__global"] = self.get_optimizer(cfg.optimizer.name, cfg.optimizer,
-                                                             global_opt_parameters, cfg)
+            # each pipeline stage has its own global optimizer
+            key = self.replica_key("__global" if self.pipeline_stages is None else f"__global.stage{self.rank}",
+                                   replica)
+            self.optimizers[key] = self.get_optimizer(cfg.optimizer.name, cfg.optimizer, global_opt_parameters, cfg)
 
             if "scheduler" in cfg.optimizer:
                 sched = cfg.optimizer.scheduler
-                self.schedulers["__global"] = self.get_scheduler(sched.name, self.optimizers["__global"], sched, cfg)
+                self.schedulers[key] = self.get_scheduler(sched.name, self.optimizers[key], sched, cfg)
+                self.scheduler_replicas[key] = replica
+
+    def get_parts(self):
+        """
+        Model parts without their DistributedDataParallel wrappers
+        """
+        return {k: unwrap_part(self.model_parts[k]) for k in self.model_parts}
+
+    def unwrapped(self):
+        """
+        The trainer itself or, if some parts are wrapped in DistributedDataParallel, a shallow copy using the bare parts
+        (validation runs on a single rank and must not trigger DDP collectives)
+        """
+        parts = self.get_parts()
+        if all(parts[k] is self.model_parts[k] for k in parts):
+            return self
+
+        trainer = copy.copy(self)
+        redirect_part_attributes(trainer, self.model_parts, parts)
+        trainer.model_parts = parts
+        return trainer
+
+    def make_ddp(self, module, ddp_kwargs, hook_cfg):
+        if self.device.type == "cuda":
+            model = DistributedDataParallel(module, device_ids=[self.device], output_device=self.device, **ddp_kwargs)
+        else:
+            model = DistributedDataParallel(module, **ddp_kwargs)
+
+        register_comm_hook(model, hook_cfg)
+        return model
+
+    def wrap_parts_ddp(self):
+        """
+        Wrap each trainable part in its own DistributedDataParallel, options come from the global `ddp` section of the
+        configuration, overridden by the `ddp` section of each part
+        """
+        parts = dict(self.model_parts)
+        for name in self.cfg.parts:
+            part_cfg = self.cfg.parts[name]
+            if part_cfg.get("frozen", False) or not any(p.requires_grad for p in parts[name].parameters()):
+                continue
+
+            ddp_cfg = OmegaConf.merge(self.cfg.get("ddp", dict()), part_cfg.get("ddp", dict()))
+            self.model_parts[name] = self.make_ddp(parts[name], self.standardize_kwargs(ddp_cfg, **DDP_DEFAULTS),
+                                                   self.standardize_kwargs(ddp_cfg, **DDP_HOOK_DEFAULTS))
+
+        redirect_part_attributes(self, parts, self.model_parts)
+
+    def shard_optimizers(self):
+        """
+        Partition the state of every optimizer across ranks (ZeRO stage 1)
+        """
+        for k in self.optimizers:
+            optimizer = self.optimizers[k]
+            if isinstance(optimizer, ZeroRedundancyOptimizer):
+                continue
+
+            # the constructor arguments of torch optimizers are their defaults, param groups keep their own values
+            self.optimizers[k] = ZeroRedundancyOptimizer(optimizer.param_groups, optimizer_class=type(optimizer),
+                                                         **optimizer.defaults)
+            if k in self.schedulers:
+                self.schedulers[k].optimizer = self.optimizers[k]
+
+    def sharded_optimizers(self):
+        return any(isinstance(optimizer, ZeroRedundancyOptimizer) for optimizer in self.optimizers.values())
+
+    def consolidate_optimizers(self):
+        """
+        Gather the sharded optimizer states on rank 0 so that it can save them, must be called by every rank
+        """
+        for optimizer in self.optimizers.values():
+            if isinstance(optimizer, ZeroRedundancyOptimizer):
+                optimizer.consolidate_state_dict(to=0)
+
+    def prepare_checkpoint(self):
+        """
+        Collective operations needed by rank 0 to save a checkpoint, must be called by every rank
+        """
+        self.consolidate_optimizers()
+
+        # the RNG states of every rank are gathered when all the ranks take part in the save (with pipeline stages or
+        # sharded optimizers), otherwise only the state of rank 0 is saved and all the ranks resume from it
+        self.rank_rng_states = None
+        if self.world_size > 1 and (self.pipeline is not None or self.sharded_optimizers()):
+            states = [None] * self.world_size if self.rank == 0 else None
+            dist.gather_object(get_rng_states(), states, dst=0)
+            self.rank_rng_states = states
 
-    @abc.abstractmethod
     def train_step(self, batch, batch_idx, train_metrics):
-        pass
+        """
+        Forward pass of a batch, returns the loss. Not used with pipeline parallelism (see `pipeline_loss`).
+        """
+        raise Exception("Training requires overriding 'train_step'")
 
     def validation_step(self, batch, batch_idx):
         return dict()
@@ -159,34 +537,291 @@ class BaseTrainer(abc.ABC):
     def pack_model(self):
         return None
 
-    def validate(self, epoch, train_batch, using_mixed_precision):
-        if self.validation_dataloader is not None:
-            print("Validating model")
-            self.before_validation(epoch, train_batch)
-            estimators = dict()
-            for batch_idx, batch in enumerate(tqdm(self.validation_dataloader)):
-                with torch.no_grad():
-                    batch = move_to_device(batch, self.device)
+    def pipeline_inputs(self, batch):
+        """
+        Inputs of the first part and target of the loss when training with pipeline parallelism
+        """
+        if isinstance(batch, (tuple, list)):
+            return batch[0], batch[1] if len(batch) > 1 else None
+        return batch, None
+
+    def pipeline_loss(self, output, target, train_metrics):
+        """
+        Loss of a micro-batch from the output of the last part, replaces `train_step` with pipeline parallelism
+        """
+        raise Exception("Pipeline parallelism requires overriding 'pipeline_loss'")
+
+    def pipeline_validation_step(self, output, target):
+        """
+        Validation metrics of a batch from the output of the last part, by default the loss. Meters updated by
+        `pipeline_loss` during validation are throwaway copies of the train metrics.
+        """
+        return {"loss": float(self.pipeline_loss(output, target, self.get_train_metrics()))}
+
+    def create_pipeline(self):
+        pipeline_cfg = self.cfg.pipeline if not isinstance(self.cfg.pipeline, bool) else dict()
+        kwargs = self.standardize_kwargs(pipeline_cfg, microbatches=None, schedule="1f1b")
+        names = self.pipeline_stages[self.rank]
+        print(f"Pipeline stage {self.rank} of {self.world_size} runs parts {names}, {kwargs}")
+
+        # loaders that unshard_dataloader cannot handle must give the same batches to every stage
+        if self.world_size > 1:
+            lengths = [len(x) if x is not None else 0 for x in [self.dataloader, self.validation_dataloader]]
+            all_lengths = [None] * self.world_size
+            dist.all_gather_object(all_lengths, lengths)
+            if any(x != lengths for x in all_lengths):
+                raise Exception(f"Pipeline stages must iterate the same batches, the numbers of train and validation "
+                                f"batches of the stages are {all_lengths}: data loaders must not be split across "
+                                f"ranks")
+        return Pipeline([self.model_parts[k] for k in names], self.rank, self.world_size, self.device, **kwargs)
+
+    def frozen_features(self, part_name, indices, *inputs):
+        """
+        Output of the frozen part `part_name` for the training samples with dataset indices `indices`.
+        When the part sets `feature_cache` the outputs are stored on disk the first time and read back afterwards.
+        """
+        part = self.model_parts[part_name]
+        cache_cfg = self.cfg.parts[part_name].get("feature_cache", False)
+        # the cache is indexed by training samples, validation runs the part
+        if not cache_cfg or torch.is_inference_mode_enabled():
+            return part(*inputs)
+
+        if part_name not in self.feature_caches:
+            self.feature_caches[part_name] = self.create_feature_cache(part_name, cache_cfg)
+        return self.feature_caches[part_name].get(indices, part, *inputs)
+
+    def create_feature_cache(self, part_name, cache_cfg):
+        if part_name not in self.frozen_parts:
+            raise Exception(f"Feature cache of part '{part_name}' requires the part to be frozen")
+
+        cache_cfg = cache_cfg if not isinstance(cache_cfg, bool) else dict()
+        # by default the cache belongs to the model (and to its dataset), caches of its previous weights are removed.
+        # An explicit `path` can be shared by models trained on the same data, old caches are then never removed
+        # since other runs may be using them
+        path = cache_cfg.get("path", None)
+        remove_stale = path is None
+        if path is None:
+            if self.model_path is None:
+                raise Exception("Feature cache requires a `path` when there is no model folder")
+            path = os.path.abspath(self.model_path) + ".feature_cache"
+
+        num_samples = cache_cfg.get("num_samples", None)
+        if num_samples is None:
+            num_samples = dataset_size(self.dataloader)
+            if num_samples is None:
+                raise Exception(f"Cannot find the size of the training set, set `num_samples` in the feature cache "
+                                f"of part '{part_name}'")
 
-                    metrics = self.validation_step(batch, batch_idx)
+        # with data parallelism all the ranks open the same cache, rank 0 removes the stale ones while the others wait
+        shared = self.world_size > 1 and self.pipeline_stages is None
+        if shared and self.rank != 0:
+            dist.barrier()
+        cache = FeatureCache(os.path.join(path, part_name), unwrap_part(self.model_parts[part_name]), num_samples,
+                             remove_stale and (not shared or self.rank == 0))
+        if shared and self.rank == 0:
+            dist.barrier()
+        return cache
+
+    def run_validation(self, trainer, using_mixed_precision, progress=True):
+        """
+        Evaluate the validation set with the parts of `trainer` (either self or a snapshot of it) in eval mode
+        """
+        parts = trainer.model_parts
+        training = {k: parts[k].training for k in parts}
+        for k in parts:
+            parts[k].eval()
+
+        # validation data order must not depend on (nor consume) the global RNG used by training
+        set_dataloader_epoch(self.validation_dataloader, 0, self.seed)
+
+        estimators = dict()
+        try:
+            with torch.inference_mode(), precision_autocast(self.precision, self.device, using_mixed_precision):
+                batches = tqdm(self.validation_dataloader, disable=not progress or self.rank != 0)
+                for batch_idx, batch in enumerate(batches):
+                    batch = move_to_device(batch, self.device, self.memory_format)
+
+                    if self.pipeline is not None:
+                        inputs, target = self.pipeline_inputs(batch)
+                        output = self.pipeline.forward(inputs)
+                        metrics = self.pipeline_validation_step(output, target) if self.pipeline.is_last else dict()
+                    else:
+                        metrics = trainer.validation_step(batch, batch_idx)
+                    if self.ensemble > 1:
+                        metrics = split_replica_values(metrics)
                     # by default weight by batch size
                     w = float(metrics.get("weight", get_batch_size(batch)))
                     for k in metrics:
                         if k not in estimators:
                             estimators[k] = AvgEstimator()
                         estimators[k].update(metrics[k], w)
+        finally:
+            for k in parts:
+                parts[k].train(training[k])
 
-            estimators = {k: estimators[k].get() for k in estimators}
+        estimators = {k: estimators[k].get() for k in estimators}
+        # metrics are computed by the last stage
+        if self.pipeline is not None:
+            estimators = self.pipeline.broadcast_object(estimators)
+        return estimators
+
+    def validate(self, epoch, train_batch, using_mixed_precision):
+        if self.validation_dataloader is not None and self.async_validation:
+            self.validate_async(epoch, train_batch, using_mixed_precision)
+            return
+
+        if self.validation_dataloader is not None:
+            print("Validating model")
+            self.before_validation(epoch, train_batch)
+            estimators = self.run_validation(self.unwrapped(), using_mixed_precision)
             print(estimators)
         else:
             estimators = dict()
 
-        if self.saver is not None:
-            self.saver.save(self.model_parts, self.optimizers, epoch, train_batch,
-                            estimators)
+        self.save_checkpoint(epoch, train_batch, estimators)
 
         # TODO barrier?
 
+    def snapshot_validator(self):
+        """
+        Copy the current weights into the validation parts and return a shallow copy of the trainer that uses them.
+        Attributes of the trainer that reference a model part (e.g. `self.encoder = self.model_parts["encoder"]`)
+        are redirected to the corresponding snapshot.
+        """
+        parts = self.get_parts()
+        if self.validation_parts is None:
+            self.validation_parts = {k: copy.deepcopy(parts[k]) for k in parts}
+            for k in self.validation_parts:
+                for p in self.validation_parts[k].parameters():
+                    p.grad = None
+                    p.requires_grad_(False)
+
+        with torch.no_grad():
+            for k in parts:
+                self.validation_parts[k].load_state_dict(parts[k].state_dict())
+
+        validator = copy.copy(self)
+        redirect_part_attributes(validator, self.model_parts, self.validation_parts)
+        redirect_part_attributes(validator, parts, self.validation_parts)
+        validator.model_parts = self.validation_parts
+
+        return validator
+
+    def validate_async(self, epoch, train_batch, using_mixed_precision):
+        # the snapshot is reused, wait until the previous validation is done with it
+        self.wait_validation()
+
+        print(f"Validating model asynchronously at {epoch}.{train_batch}")
+        self.before_validation(epoch, train_batch)
+        validator = self.snapshot_validator()
+
+        snapshot_ready = None
+        if self.device.type == "cuda":
+            snapshot_ready = torch.cuda.Event()
+            snapshot_ready.record()
+
+        # weights and optimizers are saved now, metrics are added to the checkpoint when ready
+        self.save_checkpoint(epoch, train_batch, dict())
+
+        self.validation_future = self.validation_executor.submit(self._validate_snapshot, validator, snapshot_ready,
+                                                                 epoch, train_batch, using_mixed_precision)
+
+    def _validate_snapshot(self, validator, snapshot_ready, epoch, train_batch, using_mixed_precision):
+        if snapshot_ready is not None:
+            stream = torch.cuda.Stream(self.device)
+            stream.wait_event(snapshot_ready)
+            with torch.cuda.stream(stream):
+                estimators = self.run_validation(validator, using_mixed_precision, progress=False)
+            stream.synchronize()
+        else:
+            estimators = self.run_validation(validator, using_mixed_precision, progress=False)
+
+        print(f"Validation at {epoch}.{train_batch}:", estimators)
+        if self.saver is not None:
+            self.saver.save_metrics(epoch, train_batch, estimators)
+
+    def wait_validation(self):
+        if self.validation_future is not None:
+            future, self.validation_future = self.validation_future, None
+            # re-raises exceptions of the validation thread
+            future.result()
+
+    def save_checkpoint(self, epoch, train_batch, metrics):
+        if self.pipeline is not None:
+            self.save_pipeline_checkpoint(epoch, train_batch, metrics)
+        elif self.saver is not None:
+            self.saver.save(self.get_parts(), self.optimizers, epoch, train_batch,
+                            metrics, self.state_dict(epoch, train_batch))
+
+        self.last_checkpoint_time = time.time()
+
+    def save_pipeline_checkpoint(self, epoch, train_batch, metrics):
+        """
+        Gather the parts, optimizers and schedulers of all the stages on rank 0 and save them in a single checkpoint,
+        must be called by every rank
+        """
+        trainer_state = self.state_dict(epoch, train_batch)
+        gathered = self.pipeline.gather({k: v.state_dict() for k, v in self.get_parts().items()},
+                                        {k: v.state_dict() for k, v in self.optimizers.items()},
+                                        trainer_state["schedulers"])
+        if gathered is not None and self.saver is not None:
+            parts, optimizers, trainer_state["schedulers"] = gathered
+            self.saver.save_state(parts, optimizers, epoch, train_batch, metrics, trainer_state)
+
+    def checkpoint_due(self):
+        due = self.checkpoint_every > 0 and time.time() - self.last_checkpoint_time >= self.checkpoint_every * 60
+
+        # with sharded optimizers or pipeline stages every rank takes part in the save, follow the clock of rank 0.
+        # All the ranks call this at the same steps, so they poll it together
+        if self.checkpoint_every > 0 and (self.sharded_optimizers() or self.pipeline is not None):
+            self.checkpoint_polls += 1
+            if self.checkpoint_polls % self.checkpoint_check_every != 0:
+                return False
+            flag = torch.tensor([int(due)], device=self.device)
+            dist.broadcast(flag, src=0)
+            due = flag.item() > 0
+
+        return due
+
+    def state_dict(self, epoch, train_batch):
+        """
+        State needed to resume training right after batch `train_batch` of `epoch`
+        (`train_batch` equal to the number of batches means that the epoch is over)
+        """
+        if train_batch >= len(self.dataloader):
+            epoch, train_batch = epoch + 1, 0
+        else:
+            train_batch += 1
+
+        return {
+            "epoch": epoch,
+            "batch": train_batch,
+            "schedulers": {k: self.schedulers[k].state_dict() for k in self.schedulers},
+            "scaler": self.scaler.state_dict(),
+            "precision": self.precision,
+            "metrics": {k: self.train_metrics[k].state_dict() for k in self.train_metrics
+                        if hasattr(self.train_metrics[k], "state_dict")},
+            "rng": get_rng_states(),
+            "rank_rng": self.rank_rng_states,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.start_epoch = state_dict["epoch"]
+        self.start_batch = state_dict["batch"]
+
+        for k in state_dict["schedulers"]:
+            # each pipeline stage loads the schedulers of its own optimizers
+            if self.pipeline_stages is not None and k not in self.schedulers:
+                continue
+            self.schedulers[k].load_state_dict(state_dict["schedulers"][k])
+        self.scaler.load_state_dict(state_dict["scaler"])
+        for k in state_dict["metrics"]:
+            self.train_metrics[k].load_state_dict(state_dict["metrics"][k])
+        # checkpoints saved by rank 0 alone have only its state
+        rank_states = state_dict.get("rank_rng", None)
+        set_rng_states(rank_states[self.rank] if rank_states is not None and len(rank_states) == self.world_size
+                       else state_dict["rng"])
+
     def compute_validate_every(self, validate_every=-1):
         # Define the set of batches IDs after which model is validated
         if validate_every == -1:
@@ -219,77 +854,238 @@ class BaseTrainer(abc.ABC):
         # Define the set of batches IDs after which model is validated
         validate_every = self.compute_validate_every(validate_every)
 
+        # before starting any background thread, they are pinned to the background cores
+        if self.cfg.get("cpu_affinity", False):
+            self.set_cpu_affinity()
+
         if self.logger is not None:
             self.logger.min_wait = logger_min_wait
 
-        using_mixed_precision = self.cfg.get("mixed_precision", False)
+            # serve live metrics in Prometheus format (opt-in)
+            exporter_cfg = self.cfg.get("metrics_exporter", None)
+            if exporter_cfg:
+                # `true` uses the default port, a number is the port
+                if isinstance(exporter_cfg, bool):
+                    exporter_cfg = dict()
+                elif isinstance(exporter_cfg, int):
+                    exporter_cfg = {"port": exporter_cfg}
+                background = self.cpu_layout["background"] if self.cpu_layout is not None else None
+                self.logger.start_exporter(device=self.device, cores=background, **self.standardize_kwargs(
+                    exporter_cfg, port=9400, host="127.0.0.1", publish_every=1.0))
+
+        using_mixed_precision = self.precision != "fp32"
         # if using_mixed_precision:
         #     self.init_apex(num_losses)
 
-        if distributed_data_parallel:
+        if self.pipeline_stages is not None:
+            self.pipeline = self.create_pipeline()
+        elif distributed_data_parallel:
             self.model = self.pack_model()
             if self.model is None:
-                raise Exception("When using distributed training you need to implement `pack_model`")
-            print("Initializing DistributedDataParallel")
-            self.model = DistributedDataParallel(self.model, device_ids=[self.device], output_device=self.device)
+                print("Initializing DistributedDataParallel for each trainable part")
+                self.wrap_parts_ddp()
+            else:
+                print("Initializing DistributedDataParallel")
+                ddp_cfg = self.cfg.get("ddp", dict())
+                self.model = self.make_ddp(self.model, self.standardize_kwargs(ddp_cfg, **DDP_DEFAULTS),
+                                           self.standardize_kwargs(ddp_cfg, **DDP_HOOK_DEFAULTS))
+
+        if self.preemption is not None:
+            self.preemption.install()
+        self.last_checkpoint_time = time.time()
+
+        # meters of all ranks are summed before logging, with pipeline parallelism only the last stage updates them
+        if self.world_size > 1 and (self.pipeline is not None or
+                                    (distributed_data_parallel and self.cfg.get("aggregate_metrics", False))):
+            self.metrics_reducer = MetricsReducer([m for metric in self.train_metrics.values()
+                                                   for m in getattr(metric, "meters", [metric])],
+                                                  self.device, self.rank, self.world_size, logger_min_wait)
 
         if self.rank == 0:
             print("\n")
             print("=" * 20, "TRAINING", "=" * 20)
 
         if self.logger is not None:
-            self.logger.start(self.dataloader)
+            self.logger.start(self.dataloader, self.start_epoch, self.start_batch)
 
         return validate_every, using_mixed_precision
 
+    def optimization_step(self, batch, batch_idx, using_mixed_precision):
+        """
+        Forward, backward and optimizers step on a batch, returns the loss computed by `train_step`
+        """
+        # zero grad
+        for optim in self.optimizers.values():
+            optim.zero_grad()
+
+        # move data to device
+        batch = move_to_device(batch, self.device, self.memory_format)
+
+        if self.pipeline is not None:
+            return self.pipeline_optimization_step(batch, using_mixed_precision)
+
+        # do forward step
+        forward_start = time.perf_counter()
+        with precision_autocast(self.precision, self.device, using_mixed_precision):
+            loss = self.train_step(batch, batch_idx, self.train_metrics)
+        self.forward_time = time.perf_counter() - forward_start
+
+        if isinstance(loss, torch.Tensor):
+            # an ensemble returns a loss per replica, replicas don't share parameters so their gradients are independent
+            total_loss = loss.sum() if loss.dim() > 0 else loss
+            if self.scaler.is_enabled():
+                self.scaler.scale(total_loss).backward()
+                if self.measure_statistics:
+                    # statistics are measured on the actual gradients, `step` doesn't unscale them again
+                    for optim in self.optimizers.values():
+                        self.scaler.unscale_(optim)
+                    self.parameter_statistics.before_step(self.model_parts)
+                for optim in self.optimizers.values():
+                    self.scaler.step(optim)
+                self.scaler.update()
+            else:
+                total_loss.backward()
+                if self.measure_statistics:
+                    self.parameter_statistics.before_step(self.model_parts)
+                for optim in self.optimizers.values():
+                    optim.step()
+
+            if self.measure_statistics:
+                self.parameter_statistics.after_step(self.model_parts)
+
+        return loss
+
+    def pipeline_optimization_step(self, batch, using_mixed_precision):
+        inputs, target = self.pipeline_inputs(batch)
+
+        # time of the whole schedule, forward and backward of the micro-batches are interleaved
+        forward_start = time.perf_counter()
+        loss = self.pipeline.train_step(inputs, target,
+                                        lambda output, y: self.pipeline_loss(output, y, self.train_metrics),
+                                        get_batch_size(batch),
+                                        lambda: precision_autocast(self.precision, self.device, using_mixed_precision))
+        self.forward_time = time.perf_counter() - forward_start
+
+        if self.measure_statistics:
+            self.parameter_statistics.before_step(self.model_parts)
+        for optim in self.optimizers.values():
+            optim.step()
+        if self.measure_statistics:
+            self.parameter_statistics.after_step(self.model_parts)
+
+        return loss
+
+    def statistics_due(self, last_batch):
+        """
+        Parameter statistics are measured at the steps that will be logged
+        """
+        if self.parameter_statistics is None:
+            return False
+        if self.metrics_reducer is not None:
+            return self.metrics_reducer.reduce_due(last_batch)
+        return self.logger is not None and self.logger.log_due(last_batch)
+
     def train(self, validate_every=-1, logger_min_wait=5, distributed_data_parallel=False):
+        try:
+            self._train_loop(validate_every, logger_min_wait, distributed_data_parallel)
+            self.wait_validation()
+        finally:
+            if self.preemption is not None:
+                self.preemption.uninstall()
+            if self.logger is not None:
+                self.logger.stop_exporter()
+            if self.validation_executor is not None:
+                self.validation_executor.shutdown(wait=True)
+
+    def _train_loop(self, validate_every, logger_min_wait, distributed_data_parallel):
         self.before_training()
         validate_every, using_mixed_precision = self.init_training(validate_every, logger_min_wait, distributed_data_parallel, 1)
 
-        scaler = torch.cuda.amp.GradScaler() if using_mixed_precision else None
-
-        for epoch in range(self.epochs):
+        for epoch in range(self.start_epoch, self.epochs):
             self.before_train_epoch(epoch)
-            for batch_idx, batch in enumerate(self.dataloader):
-                # zero grad
-                for optim in self.optimizers.values():
-                    optim.zero_grad()
 
-                # move data to device
-                batch = move_to_device(batch, self.device)
+            # when resuming skip the batches that have already been used in this epoch
+            start_batch = self.start_batch if epoch == self.start_epoch else 0
+            set_dataloader_epoch(self.dataloader, epoch, self.seed)
+            data_start = time.perf_counter()
+            for batch_idx, batch in enumerate(skip_batches(self.dataloader, start_batch), start_batch):
+                data_time = time.perf_counter() - data_start
+                last_batch = batch_idx == len(self.dataloader) - 1
+                self.measure_statistics = self.statistics_due(last_batch)
+                loss = self.optimization_step(batch, batch_idx, using_mixed_precision)
 
-                # do forward step
-                with amp.autocast(enabled=using_mixed_precision):
-                    loss = self.train_step(batch, batch_idx, self.train_metrics)
+                if isinstance(loss, torch.Tensor) and self.schedulers:
+                    loss_values = loss.detach().reshape(-1).tolist()
+                    for name in self.schedulers:
+                        self.schedulers[name].step(loss_values[self.scheduler_replicas.get(name, 0)])
 
-                if isinstance(loss, torch.Tensor):
-                    if using_mixed_precision:
-                        scaler.scale(loss).backward()
-                        for optim in self.optimizers.values():
-                            scaler.step(optim)
-                        scaler.update()
-                    else:
-                        loss.backward()
-                        for optim in self.optimizers.values():
-                            optim.step()
+                log = None
+                if self.metrics_reducer is not None:
+                    log = self.metrics_reducer.step(data_time + self.forward_time, last_batch=last_batch)
+                    if log and self.logger is None:
+                        self.reset_train_metrics()
+                elif self.parameter_statistics is not None:
+                    # the logged steps are the measured ones
+                    log = self.measure_statistics
 
-                    for name in self.schedulers:
-                        self.schedulers[name].step(loss.item())
+                if self.measure_statistics:
+                    statistics = self.parameter_statistics.collect(self.pipeline is not None and self.world_size > 1)
+                    if self.logger is not None:
+                        self.logger.statistics = statistics
 
                 if self.logger is not None:
-                    self.logger.batch()
+                    if log and self.metrics_reducer is not None:
+                        self.logger.extra = self.metrics_reducer.stats()
+                    self.logger.batch(get_batch_size(batch), data_time, log)
+
+                if self.preemption is not None and self.preemption.should_stop(self.device, self.world_size > 1):
+                    self.prepare_checkpoint()
+                    if self.rank == 0:
+                        print("Received termination signal, saving checkpoint and stopping")
+                    if self.rank == 0 or self.pipeline is not None:
+                        self.save_checkpoint(epoch, batch_idx, dict())
+                    self.interrupted = True
+                    return
 
                 # TODO split validation across nodes
-                if batch_idx in validate_every and self.rank == 0:
-                    self.validate(epoch, batch_idx, using_mixed_precision)
+                if batch_idx in validate_every:
+                    self.prepare_checkpoint()
+                    if self.rank == 0 or self.pipeline is not None:
+                        self.validate(epoch, batch_idx, using_mixed_precision)
+                elif self.checkpoint_due():
+                    self.prepare_checkpoint()
+                    if self.rank == 0 or self.pipeline is not None:
+                        self.save_checkpoint(epoch, batch_idx, dict())
+
+                data_start = time.perf_counter()
+
+            if self.metrics_reducer is not None:
+                self.metrics_reducer.end_epoch()
+                if self.logger is not None:
+                    self.logger.extra = self.metrics_reducer.stats()
+                else:
+                    self.reset_train_metrics(epoch=True)
 
             if self.logger is not None:
                 self.logger.epoch()
 
+            for cache in self.feature_caches.values():
+                cache.flush()
+
             # TODO split validation across nodes
-            if self.rank == 0:
+            self.prepare_checkpoint()
+            # every pipeline stage takes part in validation
+            if self.rank == 0 or self.pipeline is not None:
                 self.validate(epoch, len(self.dataloader), using_mixed_precision)
 
+    def reset_train_metrics(self, epoch=False):
+        # on ranks without a logger, which would otherwise reset them after logging
+        for meter in self.train_metrics.values():
+            if hasattr(meter, "reset"):
+                meter.reset()
+            if epoch and hasattr(meter, "reset_epoch"):
+                meter.reset_epoch()
+
     def before_training(self):
         pass
 
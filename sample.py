@@ -1,9 +1,8 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import TensorDataset, DataLoader
 import time
 
-from erlich import Erlich, BaseTrainer, AverageEstimator
+from erlich import Erlich, BaseTrainer, AverageEstimator, TensorLoader
 
 
 def create_model_part(name, part_cfg, cfg):
@@ -18,17 +17,16 @@ class ModelTrainer(BaseTrainer):
         return AverageEstimator("loss")
 
     def get_dataloader(self, batch_size):
-        return DataLoader(TensorDataset(torch.Tensor(64, 4).normal_()), batch_size=batch_size, pin_memory=True,
-                          drop_last=True,
-                          shuffle=True,
-                          num_workers=4)
+        return TensorLoader(torch.Tensor(64, 4).normal_(), batch_size=batch_size,
+                            drop_last=True,
+                            shuffle=True,
+                            device=self.device)
 
     def get_validation_dataloader(self, validation_batch_size):
-        return DataLoader(TensorDataset(torch.Tensor(64, 4).normal_()), batch_size=validation_batch_size,
-                          pin_memory=True,
-                          drop_last=True,
-                          shuffle=True,
-                          num_workers=4)
+        return TensorLoader(torch.Tensor(64, 4).normal_(), batch_size=validation_batch_size,
+                            drop_last=True,
+                            shuffle=True,
+                            device=self.device)
 
     def pack_model(self):
         return self.model_parts["sino_denoiser"]
@@ -0,0 +1,77 @@
+import json
+import os
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, DistributedSampler, TensorDataset
+
+from erlich import AverageEstimator, BaseTrainer, Erlich, TensorLoader
+
+N_SAMPLES = 40
+
+
+def identity_part(arch, cfg, gcfg):
+    # trained with lr 0, the output of the pipeline is its input
+    part = nn.Linear(1, 1)
+    with torch.no_grad():
+        part.weight.fill_(1.0)
+        part.bias.zero_()
+    return part
+
+
+class AlignmentTrainer(BaseTrainer):
+    """
+    Targets are equal to the inputs, the last stage records whether the output it receives matches its target
+    """
+
+    def data(self):
+        x = torch.arange(N_SAMPLES, dtype=torch.float32).unsqueeze(1)
+        return x, x.clone()
+
+    def get_dataloader(self, batch_size):
+        # sharded across ranks by default
+        return TensorLoader(*self.data(), batch_size=batch_size, shuffle=True, seed=self.seed)
+
+    def get_validation_dataloader(self, validation_batch_size):
+        dataset = TensorDataset(*self.data())
+        return DataLoader(dataset, batch_size=validation_batch_size, sampler=DistributedSampler(dataset, shuffle=True))
+
+    def get_train_metrics(self):
+        return {"loss": AverageEstimator("loss")}
+
+    def pipeline_loss(self, output, target, train_metrics):
+        loss = ((output - target) ** 2).mean()
+        train_metrics["loss"].update(loss.item())
+
+        kind = "validation" if torch.is_inference_mode_enabled() else "train"
+        with open(self.cfg.record_path, "a") as f:
+            f.write(json.dumps({"kind": kind, "samples": target.size(0),
+                                "aligned": torch.equal(output.detach(), target)}) + "\n")
+        return loss
+
+
+def test_pipeline_stages_see_the_same_batches(tmp_path):
+    record_path = str(tmp_path / "records.jsonl")
+    cfg = OmegaConf.create({
+        "parts": {"a": {"arch": "a"}, "b": {"arch": "b"}},
+        "optimizer": {"name": "sgd", "lr": 0.0},
+        "batch_size": 8,
+        "validation_batch_size": 8,
+        "epochs": 2,
+        "pipeline": {"microbatches": 2},
+        "record_path": record_path,
+    })
+
+    erlich = Erlich(str(tmp_path), str(tmp_path / "models"), identity_part,
+                    shared_file_path=str(tmp_path / "sharedfile"))
+    erlich.train(AlignmentTrainer, cfg, ["cpu", "cpu"], logger_min_wait=100)
+
+    assert os.path.exists(record_path)
+    with open(record_path) as f:
+        records = [json.loads(line) for line in f]
+
+    assert all(r["aligned"] for r in records)
+    # every epoch covers the whole dataset, validation runs once per epoch
+    for kind in ["train", "validation"]:
+        assert sum(r["samples"] for r in records if r["kind"] == kind) == cfg.epochs * N_SAMPLES
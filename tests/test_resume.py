@@ -0,0 +1,59 @@
+import shutil
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from erlich import AverageEstimator, BaseTrainer, Erlich, TensorLoader
+from erlich.saver import load_checkpoint
+
+
+def part(arch, cfg, gcfg):
+    # dropout consumes the global RNG, the resumed run must restore it
+    return nn.Sequential(nn.Linear(4, 16), nn.ReLU(), nn.Dropout(0.2), nn.Linear(16, 1))
+
+
+class ResumeTrainer(BaseTrainer):
+    def get_dataloader(self, batch_size):
+        generator = torch.Generator().manual_seed(0)
+        x = torch.randn(48, 4, generator=generator)
+        y = x.sum(dim=1, keepdim=True)
+        return TensorLoader(x, y, batch_size=batch_size, shuffle=True, seed=self.seed)
+
+    def get_train_metrics(self):
+        return {"loss": AverageEstimator("loss")}
+
+    def train_step(self, batch, batch_idx, train_metrics):
+        x, y = batch
+        loss = ((self.model_parts["net"](x) - y) ** 2).mean()
+        train_metrics["loss"].update(loss.item())
+        return loss
+
+
+def test_resume_mid_epoch_matches_uninterrupted_run(tmp_path):
+    cfg = OmegaConf.create({
+        "parts": {"net": {"arch": "net"}},
+        "optimizer": {"name": "adam", "lr": 1e-2,
+                      "scheduler": {"name": "warmup_plateau", "lr": 1e-2, "warmup_batches": 4, "plateau_size": 5,
+                                    "patience": 2}},
+        "batch_size": 8,
+        "validation_batch_size": 8,
+        "epochs": 3,
+    })
+
+    erlich = Erlich(str(tmp_path), str(tmp_path / "models"), part)
+    # a checkpoint every 2 batches, the ones in the middle of an epoch are resumed from
+    erlich.train(ResumeTrainer, cfg, ["cpu"], validate_every=2, logger_min_wait=100)
+    _, _, latest = erlich.get_checkpoint("0")
+    uninterrupted = tmp_path / "uninterrupted.pth"
+    shutil.copy(erlich.storage.local_path(latest), uninterrupted)
+    expected = load_checkpoint(str(uninterrupted))
+
+    erlich.resume(ResumeTrainer, "0@1.2", ["cpu"], validate_every=2, logger_min_wait=100)
+    _, _, latest = erlich.get_checkpoint("0")
+    resumed = load_checkpoint(latest, backend=erlich.storage)
+
+    for k, v in expected["parts"]["net"].items():
+        assert torch.equal(resumed["parts"]["net"][k], v), k
+    assert resumed["trainer"]["schedulers"] == expected["trainer"]["schedulers"]
+    assert resumed["trainer"]["metrics"] == expected["trainer"]["metrics"]
@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+
+from erlich.schedulers import WarmupPlateauScheduler
+
+PLATEAU_SIZE = 16
+
+
+def pinv_fit(loss_values):
+    """
+    Slope and intercept of the line through the window, as previously computed with the pseudo-inverse
+    """
+    xx = (np.arange(len(loss_values), dtype=np.float64) - len(loss_values)).reshape(1, -1)
+    A = np.linalg.pinv(np.vstack((xx, np.ones(len(loss_values)))))
+    mb = np.dot(np.asarray(loss_values, dtype=np.float64).reshape(1, -1), A)
+    return mb[0, 0], mb[0, 1]
+
+
+def make_scheduler():
+    optimizer = torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=1.0)
+    # a patience that is never reached keeps the window from being reset
+    return WarmupPlateauScheduler(optimizer, lr=1.0, warmup_batches=1, plateau_size=PLATEAU_SIZE, patience=10 ** 9)
+
+
+def loss_values(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return (10.0 * np.exp(-np.arange(n) / 50.0) + rng.normal(0.0, 0.1, n)).tolist()
+
+
+def test_ring_buffer_fit_matches_pinv_across_wrap_around():
+    scheduler = make_scheduler()
+    values = loss_values(5 * PLATEAU_SIZE + 3)
+    for i, value in enumerate(values):
+        scheduler.add_loss_value(value)
+        if i + 1 < PLATEAU_SIZE:
+            continue
+
+        window = values[i + 1 - PLATEAU_SIZE:i + 1]
+        assert scheduler.get_loss_values() == window
+        np.testing.assert_allclose(scheduler.fit_line(), pinv_fit(window), rtol=0, atol=1e-9)
+
+
+def test_fit_after_state_dict_round_trip():
+    values = loss_values(3 * PLATEAU_SIZE + 5, seed=1)
+    split = 2 * PLATEAU_SIZE + 7
+
+    scheduler = make_scheduler()
+    for value in values[:split]:
+        scheduler.step(value)
+
+    restored = make_scheduler()
+    restored.load_state_dict(scheduler.state_dict())
+    assert restored.count == scheduler.count and restored.lr == scheduler.lr
+
+    for i in range(split, len(values)):
+        scheduler.step(values[i])
+        restored.step(values[i])
+        window = values[i + 1 - PLATEAU_SIZE:i + 1]
+        np.testing.assert_allclose(restored.fit_line(), pinv_fit(window), rtol=0, atol=1e-9)
+        np.testing.assert_allclose(restored.fit_line(), scheduler.fit_line(), rtol=0, atol=1e-9)
+        assert restored.patience_count == scheduler.patience_count
@@ -0,0 +1,64 @@
+import shutil
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from erlich import AverageEstimator, BaseTrainer, Erlich, TensorLoader
+from erlich.saver import load_checkpoint
+
+
+def part(arch, cfg, gcfg):
+    return nn.Sequential(nn.Linear(4, 16), nn.Tanh(), nn.Linear(16, 1))
+
+
+class ShardedTrainer(BaseTrainer):
+    def get_dataloader(self, batch_size):
+        # each rank iterates its part of the data
+        generator = torch.Generator().manual_seed(0)
+        x = torch.randn(64, 4, generator=generator)
+        return TensorLoader(x, x.sum(dim=1, keepdim=True), batch_size=batch_size, shuffle=True, seed=self.seed)
+
+    def get_train_metrics(self):
+        return {"loss": AverageEstimator("loss")}
+
+    def train_step(self, batch, batch_idx, train_metrics):
+        x, y = batch
+        loss = ((self.model_parts["net"](x) - y) ** 2).mean()
+        train_metrics["loss"].update(loss.item())
+        return loss
+
+
+def test_consolidated_optimizer_state_reloads_and_reshards(tmp_path):
+    cfg = OmegaConf.create({
+        "parts": {"net": {"arch": "net"}},
+        "optimizer": {"name": "adam", "lr": 1e-2},
+        "batch_size": 8,
+        "validation_batch_size": 8,
+        "epochs": 2,
+        "shard_optimizer_state": True,
+    })
+
+    erlich = Erlich(str(tmp_path), str(tmp_path / "models"), part, shared_file_path=str(tmp_path / "sharedfile"))
+    erlich.train(ShardedTrainer, cfg, ["cpu", "cpu"], validate_every=2, logger_min_wait=100)
+    _, _, latest = erlich.get_checkpoint("0")
+    uninterrupted = tmp_path / "uninterrupted.pth"
+    shutil.copy(erlich.storage.local_path(latest), uninterrupted)
+    expected = load_checkpoint(str(uninterrupted))
+
+    # rank 0 saves the state of every parameter, not only of its own shard
+    n_params = len(list(part("net", None, cfg).parameters()))
+    for name, optimizer_state in expected["optimizers"].items():
+        assert len(optimizer_state["state"]) == n_params, name
+
+    (tmp_path / "sharedfile").unlink(missing_ok=True)
+    erlich.resume(ShardedTrainer, "0@0.2", ["cpu", "cpu"], validate_every=2, logger_min_wait=100)
+    _, _, latest = erlich.get_checkpoint("0")
+    resumed = load_checkpoint(latest, backend=erlich.storage)
+
+    for k, v in expected["parts"]["net"].items():
+        torch.testing.assert_close(resumed["parts"]["net"][k], v, rtol=0, atol=1e-6)
+    for name, optimizer_state in expected["optimizers"].items():
+        for i, state in optimizer_state["state"].items():
+            for k in ["exp_avg", "exp_avg_sq"]:
+                torch.testing.assert_close(resumed["optimizers"][name]["state"][i][k], state[k], rtol=0, atol=1e-6)
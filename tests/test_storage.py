@@ -0,0 +1,128 @@
+import os
+
+import torch
+
+from erlich.saver import ModelSaver, load_checkpoint, resolve_checkpoint
+from erlich.storage import LocalBackend, LocalObjectStore, ObjectStoreBackend
+
+MiB = 2 ** 20
+
+
+class CountingObjectStore(LocalObjectStore):
+    """
+    Records the requests made by the backend
+    """
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.calls = []
+
+    def upload_part(self, **kwargs):
+        self.calls.append("upload_part")
+        return super().upload_part(**kwargs)
+
+    def get_object(self, **kwargs):
+        self.calls.append("get_object")
+        return super().get_object(**kwargs)
+
+
+def make_backend(tmp_path, client=None):
+    client = client if client is not None else LocalObjectStore(str(tmp_path / "objects"))
+    return ObjectStoreBackend(client, "bucket", "models", cache_dir=str(tmp_path / "cache"), chunk_size=5 * MiB,
+                              max_workers=2)
+
+
+def test_multipart_round_trip(tmp_path):
+    client = CountingObjectStore(str(tmp_path / "objects"))
+    backend = make_backend(tmp_path, client)
+    data = os.urandom(12 * MiB + 123)
+
+    with backend.open_write("0/blob") as f:
+        # writes smaller than a chunk are buffered
+        for i in range(0, len(data), MiB):
+            f.write(data[i:i + MiB])
+
+    assert client.calls.count("upload_part") == 3
+    assert backend.read_bytes("0/blob") == data
+    with open(backend.local_path("0/blob"), "rb") as f:
+        assert f.read() == data
+    # no upload is left behind
+    assert os.listdir(tmp_path / "objects" / ".uploads" / "bucket") == []
+
+    tensor = torch.randn(2 * MiB)
+    with backend.open_write("0/tensor.pth") as f:
+        torch.save(tensor, f)
+    assert torch.equal(torch.load(backend.local_path("0/tensor.pth")), tensor)
+
+
+def test_failed_write_is_not_visible(tmp_path):
+    backend = make_backend(tmp_path)
+    try:
+        with backend.open_write("0/blob") as f:
+            f.write(os.urandom(6 * MiB))
+            raise RuntimeError("serialization failed")
+    except RuntimeError:
+        pass
+
+    assert not backend.exists("0/blob")
+
+
+def save(saver, epoch, batch):
+    parts = {"net": {"weight": torch.full((4,), float(epoch * 10 + batch))}}
+    saver.save_state(parts, dict(), epoch, batch, {"loss": 1.0})
+
+
+def test_latest_pointer_replaces_link(tmp_path):
+    backend = LocalBackend()
+    folder = str(tmp_path / "0")
+    saver = ModelSaver(folder, backend=backend)
+    save(saver, 0, 1)
+    # link written by older versions
+    os.symlink(os.path.join(folder, "0.1.pth"), os.path.join(folder, "latest.pth"))
+    save(saver, 0, 2)
+
+    assert not os.path.lexists(os.path.join(folder, "latest.pth"))
+    latest = resolve_checkpoint(backend, folder, "latest")
+    assert latest == os.path.join(folder, "0.2.pth")
+    assert load_checkpoint(latest)["parts"]["net"]["weight"][0] == 2
+
+    saver.save_metrics(0, 2, {"loss": 0.5})
+    assert saver.read_info(saver.key("latest")) == dict(saver.read_info(saver.key("0.2")), checkpoint="0.2")
+    assert saver.read_info(saver.key("latest"))["metrics"] == {"loss": 0.5}
+    # metrics of an older checkpoint don't move the pointer
+    saver.save_metrics(0, 1, {"loss": 0.7})
+    assert saver.read_info(saver.key("latest"))["checkpoint"] == "0.2"
+
+
+def test_latest_pointer_on_object_store(tmp_path):
+    backend = make_backend(tmp_path)
+    saver = ModelSaver(str(tmp_path / "local"), backend=backend, prefix="0")
+    save(saver, 0, 1)
+    backend.write_bytes("0/latest.pth", backend.read_bytes("0/0.1.pth"))
+    save(saver, 1, 0)
+
+    assert not backend.exists("0/latest.pth")
+    latest = resolve_checkpoint(backend, "0", "latest")
+    assert latest == "0/1.0.pth"
+    assert load_checkpoint(latest, backend=backend)["parts"]["net"]["weight"][0] == 10
+
+
+def test_cache_invalidated_when_etag_changes(tmp_path):
+    client = CountingObjectStore(str(tmp_path / "objects"))
+    backend = make_backend(tmp_path, client)
+    backend.write_bytes("0/object", b"first")
+
+    path = backend.local_path("0/object")
+    with open(path, "rb") as f:
+        assert f.read() == b"first"
+    downloads = client.calls.count("get_object")
+
+    # the cached copy is used while the object doesn't change
+    assert backend.local_path("0/object") == path
+    assert client.calls.count("get_object") == downloads
+
+    backend.write_bytes("0/object", b"second version")
+    path = backend.local_path("0/object")
+    with open(path, "rb") as f:
+        assert f.read() == b"second version"
+    assert client.calls.count("get_object") > downloads